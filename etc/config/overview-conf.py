@@ -32,6 +32,9 @@ server.serviceName = "Overview"
 server.options = {"thread_pool": 10, "stack_size": 512 * 1024}
 
 server.extend("OverviewCache")
+# Serve stale entries for up to 600 s while they are refreshed in the background,
+# and share cached results between server processes and across restarts:
+# server.extend("OverviewCache", 3, 100000000, 1000, 120, 5, 600, 4, 100, "overview-cache.db")
 server.source("Filelight")
 server.source("Prodmon")
 server.source("Phedex", CONFIGDIR + "/dbparam.py")
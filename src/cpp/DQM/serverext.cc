@@ -2759,6 +2759,20 @@ public:
     return ret;
   }
 
+  // Return the version of the object NAME if a copy of its data is held
+  // locally, zero otherwise.  For a stale copy this is the version just
+  // announced by the producer, which fetch() will wait for, so requests
+  // made while the new data is on its way share the same version too.
+  uint64_t version(const std::string &name) {
+    uint64_t vers = 0;
+    lock();
+    if (Object *o = findObject(0, name))
+      if (o->rawdata.size() || o->scalar.size())
+        vers = o->version;
+    unlock();
+    return vers;
+  }
+
   void fetch(const std::string &name, std::string &streamers, Object &retobj) {
     streamers = streamers_; // FIXME: from peer;
 
@@ -3014,6 +3028,11 @@ public:
     thread_->fetch(path, xstreamers, xobj);
   }
 
+  uint64_t version(const std::string &path) {
+    PyReleaseInterpreterLock nogil;
+    return thread_ ? thread_->version(path) : 0;
+  }
+
   py::tuple plot(const std::string &path, py::dict opts) {
     VisDQMSample sample(SAMPLE_ANY, -1);
     std::map<std::string, std::string> options;
@@ -5693,6 +5712,7 @@ BOOST_PYTHON_MODULE(Accelerator) {
       .add_property("plothook", &VisDQMLiveSource::plotter)
       .add_property("jsonhook", &VisDQMLiveSource::jsoner)
       .def("_plot", &VisDQMLiveSource::plot)
+      .def("_version", &VisDQMLiveSource::version)
       .def("_exit", &VisDQMLiveSource::exit);
 
   py::class_<VisDQMArchiveSource, shared_ptr<VisDQMArchiveSource>,
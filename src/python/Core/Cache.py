@@ -1,16 +1,414 @@
 from Monitoring.Core.Utils.Common import _logwarn, _loginfo
 from threading import Thread, Lock, Event
-from cherrypy import engine
+from collections import OrderedDict
+from queue import Queue, Empty, Full
+from cherrypy import engine, expose, response, tree
 import time, datetime
 import pickle
+import heapq
+import json
+import sqlite3
 import sys
+import re
 import random
 
+RX_KEY_PREFIX = re.compile(r"^[A-Za-z]+(_[A-Za-z]+)?")
+
+
+def keyprefix(key):
+    """
+    Return the statistics group of a cache key, e.g. PA_PLOT for PA_PLOT|...
+    or FL_NODE for FL_NODE:site.
+    """
+    m = RX_KEY_PREFIX.match(str(key))
+    return (m and m.group(0)) or "other"
+
+
+class CacheStats(object):
+    """
+    Thread-safe hit/miss/eviction counters, bytes held and latency
+    histograms for a cache, grouped by key prefix.  Used by OverviewCache
+    and by sources keeping their own caches, and reported as JSON by
+    OverviewCache.stats.
+    """
+
+    BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120)
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        self.groups = {}
+
+    def _group(self, prefix):
+        g = self.groups.get(prefix, None)
+        if g is None:
+            g = self.groups[prefix] = {"counts": {}, "bytes": 0, "timings": {}}
+        return g
+
+    def count(self, prefix, what, n=1):
+        """
+        Add n to counter what (hit, miss, stale, evict-size, ...) of prefix.
+        """
+        self.lock.acquire()
+        try:
+            counts = self._group(prefix)["counts"]
+            counts[what] = counts.get(what, 0) + n
+        finally:
+            self.lock.release()
+
+    def held(self, prefix, delta):
+        """
+        Adjust the number of bytes held for prefix by delta.
+        """
+        self.lock.acquire()
+        try:
+            self._group(prefix)["bytes"] += delta
+        finally:
+            self.lock.release()
+
+    def timing(self, prefix, what, seconds):
+        """
+        Record a duration in the latency histogram what (produce, wait) of prefix.
+        """
+        self.lock.acquire()
+        try:
+            timings = self._group(prefix)["timings"]
+            t = timings.get(what, None)
+            if t is None:
+                t = timings[what] = {
+                    "n": 0,
+                    "sum": 0.0,
+                    "max": 0.0,
+                    "buckets": [0] * (len(self.BUCKETS) + 1),
+                }
+            t["n"] += 1
+            t["sum"] += seconds
+            t["max"] = max(t["max"], seconds)
+            i = 0
+            while i < len(self.BUCKETS) and seconds > self.BUCKETS[i]:
+                i += 1
+            t["buckets"][i] += 1
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        """
+        Return a JSON-serialisable snapshot, with totals over all prefixes.
+        """
+        self.lock.acquire()
+        try:
+            groups = json.loads(json.dumps(self.groups))
+        finally:
+            self.lock.release()
+        total = {"counts": {}, "bytes": 0}
+        for g in groups.values():
+            total["bytes"] += g["bytes"]
+            for what, n in g["counts"].items():
+                total["counts"][what] = total["counts"].get(what, 0) + n
+        hits = total["counts"].get("hit", 0) + total["counts"].get("stale", 0)
+        lookups = hits + total["counts"].get("miss", 0)
+        total["hitratio"] = (lookups and float(hits) / lookups) or 0.0
+        return {
+            "name": self.name,
+            "buckets": list(self.BUCKETS),
+            "total": total,
+            "prefixes": groups,
+        }
+
+
+class _InFlight(object):
+    """
+    Record of a value currently being produced for lockedCacheFetch.
+    Waiters block on .done, then re-raise .error or, if .ok, take .value,
+    which is pickled (.pickled) unless the data can be shared by reference.
+    """
+
+    def __init__(self):
+        self.done = Event()
+        self.ok = False
+        self.value = None
+        self.pickled = False
+        self.error = None
+
+
+class SQLiteCacheStore(object):
+    """
+    Cache entries persisted in an SQLite file shared by all server
+    processes on the host, so that a restarted or parallel server can
+    reuse still-valid results.  Entries carry absolute expiry times, and
+    the total size of stored data and the number of entries are kept
+    below sizelimit and itemlimit by dropping the least recently accessed
+    entries.  The running totals are maintained by triggers, and expiry
+    and access time are indexed, so each operation costs O(log n).
+    Access times are only updated once they are more than
+    ATIME_RESOLUTION seconds old, so most reads do not write.
+    """
+
+    ATIME_RESOLUTION = 60
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+          key TEXT PRIMARY KEY, expiry REAL, fresh REAL, atime REAL,
+          size INTEGER, pickled INTEGER, data BLOB);
+        CREATE INDEX IF NOT EXISTS entries_expiry ON entries (expiry);
+        CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime);
+        CREATE TABLE IF NOT EXISTS total (
+          id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER);
+        INSERT OR IGNORE INTO total VALUES (0, 0);
+        CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries
+          BEGIN UPDATE total SET size = size + new.size; END;
+        CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries
+          BEGIN UPDATE total SET size = size - old.size; END;
+        CREATE TABLE IF NOT EXISTS items (
+          id INTEGER PRIMARY KEY CHECK (id = 0), n INTEGER);
+        INSERT OR IGNORE INTO items SELECT 0, COUNT(*) FROM entries;
+        CREATE TRIGGER IF NOT EXISTS entries_count_insert AFTER INSERT ON entries
+          BEGIN UPDATE items SET n = n + 1; END;
+        CREATE TRIGGER IF NOT EXISTS entries_count_delete AFTER DELETE ON entries
+          BEGIN UPDATE items SET n = n - 1; END;
+    """
+
+    def __init__(self, path, sizelimit, itemlimit=None):
+        self.path = path
+        self.sizelimit = sizelimit
+        self.itemlimit = itemlimit
+        self.lock = Lock()
+        self.db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+
+    def get(self, key):
+        """
+        Return (expiry, fresh_until, pickled, data) for an unexpired key, or None.
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            row = self.db.execute(
+                "SELECT expiry, fresh, pickled, data, atime FROM entries"
+                " WHERE key = ? AND expiry >= ?",
+                (key, now),
+            ).fetchone()
+            if row and now - row[4] > self.ATIME_RESOLUTION:
+                self.db.execute(
+                    "UPDATE entries SET atime = ? WHERE key = ?", (now, key)
+                )
+        finally:
+            self.lock.release()
+        return row and row[:4]
+
+    def put(self, key, expiry, fresh_until, pickled, data):
+        """
+        Store an entry, replacing any previous one, then drop least recently
+        accessed entries until the store is within its size and item limits.
+        """
+        self.lock.acquire()
+        try:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.db.execute(
+                    "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, expiry, fresh_until, time.time(), len(data), pickled, data),
+                )
+                while self._overlimit():
+                    self.db.execute(
+                        "DELETE FROM entries WHERE key IN"
+                        " (SELECT key FROM entries ORDER BY atime LIMIT 1)"
+                    )
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+        finally:
+            self.lock.release()
+
+    def _overlimit(self):
+        size, n = self.db.execute("SELECT size, n FROM total, items").fetchone()
+        return size > self.sizelimit or (
+            self.itemlimit is not None and n > self.itemlimit
+        )
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        finally:
+            self.lock.release()
+
+    def purge(self):
+        """
+        Delete expired entries.
+        """
+        self.lock.acquire()
+        try:
+            self.db.execute("DELETE FROM entries WHERE expiry < ?", (time.time(),))
+        finally:
+            self.lock.release()
+
+
+class _StoreWriter(object):
+    """
+    Thread writing cache entries through to an SQLiteCacheStore off the
+    request path.  Updates are queued in order and dropped if the bounded
+    queue is full; the shared store is only a second-level cache.
+    """
+
+    def __init__(self, cache, store, queuesize=1000):
+        self.cache = cache
+        self.store = store
+        self.queue = Queue(queuesize)
+        self.worker = Thread(name="OverviewCacheStore", target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def put(self, key, expiry, fresh_until, pickled, data):
+        self._submit(("put", key, expiry, fresh_until, pickled, data))
+
+    def delete(self, key):
+        self._submit(("delete", key))
+
+    def _submit(self, task):
+        try:
+            self.queue.put_nowait(task)
+        except Full:
+            self.cache.metrics.count(keyprefix(task[1]), "store-drop")
+            _logwarn("CACHE: Store queue full, dropping key=%s" % task[1])
+
+    def stop(self):
+        try:
+            self.queue.put_nowait(None)
+        except Full:
+            pass
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            key = task[1]
+            try:
+                if task[0] == "delete":
+                    self.store.delete(key)
+                    continue
+                expiry, fresh_until, pickled, data = task[2:]
+                if not pickled:
+                    data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+                self.store.put(key, expiry, fresh_until, pickled, data)
+            except (pickle.PickleError, TypeError, sqlite3.Error) as e:
+                _logwarn("CACHE: Cannot update key=%s in shared store: %s" % (key, e))
+
+
+class _RefreshPool(object):
+    """
+    Fixed set of worker threads running cache refreshes from a bounded
+    queue.  Each key is queued at most once until its refresh finishes.
+    """
+
+    def __init__(self, cache, nthreads, queuesize):
+        self.cache = cache
+        self.queue = Queue(queuesize)
+        self.pending = set()
+        self.lock = Lock()
+        self.stopme = False
+        self.workers = [
+            Thread(name="OverviewCacheRefresh-%d" % i, target=self.run)
+            for i in range(nthreads)
+        ]
+        for w in self.workers:
+            w.daemon = True
+            w.start()
+
+    def submit(self, cachekey, f_produce, args, kwargs):
+        """
+        Queue a refresh of cachekey. Returns False if the key is already
+        queued or the queue is full.
+        """
+        self.lock.acquire()
+        try:
+            if self.stopme or cachekey in self.pending:
+                return False
+            try:
+                self.queue.put_nowait((cachekey, f_produce, args, kwargs))
+            except Full:
+                _logwarn("CACHE: Refresh queue full, dropping key=%s" % cachekey)
+                return False
+            self.pending.add(cachekey)
+            return True
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """
+        Stop the workers without blocking: drop the queued refreshes and
+        wake idle workers; busy ones exit when their refresh finishes.
+        """
+        self.lock.acquire()
+        try:
+            self.stopme = True
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    break
+            for w in self.workers:
+                try:
+                    self.queue.put_nowait(None)
+                except Full:
+                    break
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None or self.stopme:
+                return
+            cachekey, f_produce, args, kwargs = task
+            self.cache.metrics.count(keyprefix(cachekey), "refresh")
+            try:
+                self.cache.asyncWorker(cachekey, f_produce, *args, **kwargs)
+            finally:
+                self.lock.acquire()
+                self.pending.discard(cachekey)
+                self.lock.release()
+
 
 class OverviewCache(Thread):
     """
     Thread-watched cache of data for prodmon (or anything else)
     All non _-prefixed methods should be thread-safe for external calling
+
+    Entries are kept in two orders: by recency of use (self.cache is an
+    OrderedDict, least recently used first) and by expiry (self.expiries
+    is a heap of (expiry, key)).  Culling by size or number pops the least
+    recently used entries, culling by age pops the heap, so each evicted
+    entry costs O(log n) and the cleanup loop only touches entries that
+    have actually expired.  Heap entries are invalidated lazily: a popped
+    (expiry, key) pair whose expiry no longer matches the cache entry is
+    simply dropped.
+
+    Immutable payloads (bytes, strings, numbers, tuples of those, and
+    objects declaring a true cacheImmutable attribute) are held by
+    reference and returned as-is.  Everything else is pickled on insert
+    and unpickled on retrieval, so that callers get a defensive copy.
+
+    With a non-zero stale_grace, an entry that has become stale when its
+    producer-given lifetime runs out is kept for a further stale_grace
+    seconds.  cacheFetch and lockedCacheFetch keep serving a stale entry
+    while a refresh runs on a fixed-size pool of worker threads, so only
+    keys that are really gone make the caller wait for the backend.
+    Stale-while-revalidate is off by default.
+
+    With a store path, entries are also written through to an
+    SQLiteCacheStore shared with other server processes, from a
+    background thread, and looked up there on a local miss.
+
+    Hit, miss and eviction counts, bytes held and producer/wait latencies
+    are kept per key prefix in .metrics, and served as JSON together with
+    those of any other registered caches at <baseUrl>/cache/stats.
     """
 
     exthook = "OverviewCache"
@@ -23,12 +421,22 @@ class OverviewCache(Thread):
         itemlimit=1000,
         wait_expiry=120,
         wait_interval=5,
+        stale_grace=0,
+        refresh_threads=4,
+        refresh_queue=100,
+        store=None,
     ):
         """
         Create a new ProdmonCache. Note that it is not started until the .start() method is called.
 
         @param interval: interval in seconds between the main loop running (3)
         @param cachesize: maximum size in bytes before old entries start getting culled. Note that this is done *imprecisely* and will not be strictly adhered to! (100MB)
+        @param wait_expiry: maximum time in seconds lockedCacheFetch waits for another thread producing the same key before producing it itself (120)
+        @param wait_interval: unused; waiters are woken when the key is produced instead of polling. Kept so positional configurations still work (5)
+        @param stale_grace: time in seconds a stale entry is still served while it is being refreshed; 0 disables stale-while-revalidate (0)
+        @param refresh_threads: number of worker threads for background refreshes and asyncCacheFill (4)
+        @param refresh_queue: maximum number of refreshes waiting for a worker; further requests are dropped (100)
+        @param store: path of an SQLite file shared with other server processes, relative to the server directory; None keeps the cache in memory only (None)
         """
         _loginfo(
             "CACHE: Creating new Overview cache interval=%s sec, sizelimit=%s bytes, itemlimit=%s"
@@ -40,13 +448,28 @@ class OverviewCache(Thread):
         self.lock = Lock()
         self.stopme = False
         self.cachesize = 0
-        self.cache = {}  # objkey: tuple (expiry, size, data)
+        # objkey: tuple (expiry, size, data, pickled, fresh_until)
+        self.cache = OrderedDict()
+        self.expiries = []  # heap of (expiry, objkey)
         self.interval = interval
         self.sizelimit = sizelimit
         self.itemlimit = itemlimit
-        self.cacheevents = {}
+        self.inflight = {}  # objkey: _InFlight
         self.wait_expiry = wait_expiry
-        self.wait_interval = wait_interval
+        self.stale_grace = stale_grace
+        self.refresher = _RefreshPool(self, refresh_threads, refresh_queue)
+        self.metrics = CacheStats("OverviewCache")
+        self.extrastats = []
+        self.store = None
+        self.storewriter = None
+        if store:
+            if gui and not store.startswith("/"):
+                store = "%s/%s" % (gui.sessiondir.rsplit("/", 1)[0], store)
+            self.store = SQLiteCacheStore(store, sizelimit, itemlimit)
+            self.storewriter = _StoreWriter(self, self.store)
+
+        if gui:
+            tree.mount(_CacheStatsPage(self), script_name=gui.baseUrl + "/cache")
 
         engine.subscribe("stop", self.stop)
         self.start()
@@ -61,6 +484,9 @@ class OverviewCache(Thread):
             self.stopme = True
         finally:
             self.lock.release()
+        self.refresher.stop()
+        if self.storewriter:
+            self.storewriter.stop()
 
     def run(self):
         while True:
@@ -69,78 +495,164 @@ class OverviewCache(Thread):
             try:
                 if self.stopme:
                     return
-                keys_to_delete = []
-                now = time.time()
-                for key in self.cache:
-                    if self.cache[key][0] < now:
-                        keys_to_delete.append(key)
-                for key in keys_to_delete:
-                    # _loginfo("CACHE: Deleting expired key: %s"%key)
-                    self._remove(key)
-
-                    # if there is an associated key
-                    if key in self.cacheevents:
-                        del self.cacheevents[key]
-
+                self._cull_expired()
             finally:
                 self.lock.release()
+            if self.store:
+                try:
+                    self.store.purge()
+                except sqlite3.Error as e:
+                    _logwarn("CACHE: Cannot purge shared store: %s" % e)
             time.sleep(self.interval)
 
-    def _get_oldest(self):
-        t = sys.maxint
-        oldest = None
-        for key in self.cache:
-            if self.cache[key][0] < t:
-                t = self.cache[key][0]
-                oldest = key
-        return oldest
+    def _cull_expired(self):
+        # Pop the expiry heap until the earliest remaining entry is still
+        # valid.  Stale heap entries (removed or re-inserted keys) are
+        # discarded without touching the cache.
+        now = time.time()
+        while self.expiries and self.expiries[0][0] < now:
+            expiry, key = heapq.heappop(self.expiries)
+            if key in self.cache and self.cache[key][0] == expiry:
+                # _loginfo("CACHE: Deleting expired key: %s"%key)
+                self._remove(key, "evict-expired")
+
+    def _compact_expiries(self):
+        # Rebuild the heap from live entries once stale ones dominate, so
+        # frequently re-inserted keys cannot grow it without bound.
+        if len(self.expiries) > 2 * len(self.cache) + 64:
+            self.expiries = [(v[0], k) for k, v in self.cache.items()]
+            heapq.heapify(self.expiries)
 
     def _cull_number(self):
         # _loginfo("CACHE: Culling excessive item number (%s)"%len(self.cache))
         while len(self.cache) > self.itemlimit:
-            self._remove(self._get_oldest())
+            self._remove(next(iter(self.cache)), "evict-number")
 
     def _cull_size(self):
         # _loginfo("CACHE: Culling excessive size (%s)"%self.cachesize)
-        while self.cachesize > self.sizelimit:
-            self._remove(self._get_oldest())
+        while self.cachesize > self.sizelimit and self.cache:
+            self._remove(next(iter(self.cache)), "evict-size")
+
+    def _immutable(self, data):
+        if data is None or isinstance(data, (bytes, str, int, float, bool)):
+            return True
+        if isinstance(data, (tuple, frozenset)):
+            return all(self._immutable(x) for x in data)
+        return getattr(data, "cacheImmutable", False)
+
+    def _payload_size(self, data):
+        if isinstance(data, (bytes, str)):
+            return len(data)
+        if isinstance(data, (tuple, frozenset)):
+            return sum(self._payload_size(x) for x in data)
+        if getattr(data, "cacheSize", None):
+            return data.cacheSize()
+        return sys.getsizeof(data)
+
+    def _store(self, key, lifetime, data, copy=None):
+        """
+        Insert data with the lock held, pickling it unless it can be held by reference.
+        @param copy: True to always pickle, False to never pickle, None to decide from the type of data
+        """
+        if copy is None:
+            copy = not self._immutable(data)
+        if copy:
+            data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            self._insert(key, lifetime, len(data), data, True)
+        else:
+            self._insert(key, lifetime, self._payload_size(data), data, False)
 
-    def _insert(self, key, lifetime, size, data):
+    def _insert(self, key, lifetime, size, data, pickled=True):
         # _loginfo("CACHE: _insert key=%s size=%s lifetime=%s" % (key,size,lifetime))
+        fresh_until = lifetime + time.time()
+        self._insert_until(
+            key, fresh_until + self.stale_grace, fresh_until, size, data, pickled
+        )
+
+    def _insert_until(self, key, expiry, fresh_until, size, data, pickled):
         if self._exists(key):
             self._remove(key)
-        self.cache[key] = (lifetime + time.time(), size, data)
+        self.cache[key] = (expiry, size, data, pickled, fresh_until)
+        heapq.heappush(self.expiries, (expiry, key))
         self.cachesize += size
+        self.metrics.held(keyprefix(key), size)
+        self.metrics.count(keyprefix(key), "insert")
+        self._cull_expired()
         if len(self.cache) > self.itemlimit:
-            self._cull_num()
+            self._cull_number()
         if self.cachesize > self.sizelimit:
             self._cull_size()
+        self._compact_expiries()
 
-    def insert(self, key, lifetime, data):
+    def insert(self, key, lifetime, data, copy=None):
         """
         Insert a new key into the cache, with associated expiry lifetime, size and data. Triggers volume cleaning if the new cache size exceeds the maximum.
         @param key: key for the new data - should be a string
         @param lifetime: desired cache lifetime of this object in seconds
         @param data: free data object. Preferably doesn't refer to other objects in the cache, or size calculations will become impossible.
+        @param copy: whether to pickle data so retrievals get a private copy; by default only mutable data is pickled
         """
+        self._insertEntry(key, lifetime, data, copy)
+
+    def _insertEntry(self, key, lifetime, data, copy=None):
+        # Insert data and write it through to the shared store, returning
+        # the new cache entry, or None if the data could not be pickled.
+        entry = None
         self.lock.acquire()
         try:
             try:
-                data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
-                self._insert(key, lifetime, len(data), data)
+                self._store(key, lifetime, data, copy)
+                entry = self.cache.get(key, None)
             except pickle.PickleError:
                 _logwarn("CACHE: Pickling error with key=%s" % key)
                 pass
         finally:
             self.lock.release()
 
-    def _remove(self, key):
+        # Write through to the shared store in the background.
+        if self.store and entry:
+            expiry, size, data, pickled, fresh_until = entry
+            self.storewriter.put(key, expiry, fresh_until, pickled, data)
+        return entry
+
+    def _load(self, key):
+        # On a local miss, copy a still valid entry from the shared store.
+        if not self.store or self.exists(key, False):
+            return
+        try:
+            row = self.store.get(key)
+        except sqlite3.Error as e:
+            _logwarn("CACHE: Cannot read key=%s from shared store: %s" % (key, e))
+            return
+        if not row:
+            return
+        expiry, fresh_until, pickled, data = row
+        try:
+            if pickled:
+                size = len(data)
+            else:
+                data = pickle.loads(data)
+                size = self._payload_size(data)
+        except pickle.PickleError:
+            _logwarn("CACHE: Unpickling error with key=%s" % key)
+            return
+        self.lock.acquire()
+        try:
+            if not self._exists(key):
+                self._insert_until(key, expiry, fresh_until, size, data, pickled)
+        finally:
+            self.lock.release()
+
+    def _remove(self, key, reason=None):
         # _loginfo("CACHE: _remove key=%s"%key)
         size = -1
         if self._exists(key):
             size = self.cache[key][1]
             self.cachesize -= size
             del self.cache[key]
+            self.metrics.held(keyprefix(key), -size)
+            if reason:
+                self.metrics.count(keyprefix(key), reason)
 
         return size
 
@@ -155,6 +667,8 @@ class OverviewCache(Thread):
             size = self._remove(key)
         finally:
             self.lock.release()
+        if self.store:
+            self.storewriter.delete(key)
         return size
 
     def retrieve(self, key, default=None):
@@ -165,23 +679,51 @@ class OverviewCache(Thread):
         @param default: what to return if the key is not in the cache (None)
         """
         # print("PC: Getting key [%s]" % (key))
-        result = default
+        self._load(key)
         self.lock.acquire()
         try:
-            if self._exists(key):
-                try:
-                    result = pickle.loads(self.cache[key][2])
-                except pickle.PickleError:
-                    _logwarn("CACHE: Unpickling error with key=%s" % key)
-                    pass
+            result = self._retrieve(key, default)
         finally:
             self.lock.release()
         return result
 
+    def _retrieve(self, key, default=None):
+        result = default
+        if not self._live(key):
+            self.metrics.count(keyprefix(key), "miss")
+        else:
+            self.metrics.count(keyprefix(key), (self._fresh(key) and "hit") or "stale")
+            self.cache.move_to_end(key)
+            data, pickled = self.cache[key][2:4]
+            if not pickled:
+                return data
+            try:
+                result = pickle.loads(data)
+            except pickle.PickleError:
+                _logwarn("CACHE: Unpickling error with key=%s" % key)
+                pass
+        return result
+
     def _exists(self, key):
         return key in self.cache
 
-    def exists(self, key):
+    def _live(self, key):
+        # Return True if key is in the cache and not yet expired, dropping
+        # it if it has expired but has not been culled yet.
+        if not self._exists(key):
+            return False
+        if self.cache[key][0] < time.time():
+            self._remove(key, "evict-expired")
+            return False
+        return True
+
+    def exists(self, key, shared=False):
+        """
+        Return True if key is in the cache; with shared, also look in the shared store.
+        Plain membership tests only look in memory, so they cost no store query.
+        """
+        if shared:
+            self._load(key)
         result = False
         self.lock.acquire()
         try:
@@ -218,7 +760,7 @@ class OverviewCache(Thread):
         """
         self.lock.acquire()
         try:
-            result = self.cache.keys()
+            result = list(self.cache.keys())
         finally:
             self.lock.release()
         return result
@@ -239,106 +781,219 @@ class OverviewCache(Thread):
         return self.exists(key)
 
     def key_wait_get(self, key):
-        value = False
+        """
+        Return True if some thread is currently producing data for key in lockedCacheFetch.
+        """
         self.lock.acquire()
         try:
-            if key in self.cacheevents:
-                value = self.cacheevents[key]
+            result = key in self.inflight
         finally:
             self.lock.release()
-        return value
+        return result
 
-    def key_wait_set(self, key, value):
-        self.lock.acquire()
+    def _fresh(self, key):
+        return self._exists(key) and self.cache[key][4] >= time.time()
+
+    def _revalidate(self, key, f_produce, args, kwargs):
+        # Called with the lock held for an existing key: queue a refresh if
+        # the entry is stale, then return the current data.
+        if not self._fresh(key) and key not in self.inflight:
+            # _loginfo("CACHE: Serving stale key=%s, refreshing"%key)
+            self.refresher.submit(key, f_produce, args, kwargs)
+        return self._retrieve(key)
+
+    def _produce(self, cachekey, f_produce, args, kwargs):
+        # Run a producer, recording how long it took.
+        start = time.time()
         try:
-            self.cacheevents[key] = value
+            return f_produce(*args, **kwargs)
         finally:
-            self.lock.release()
+            self.metrics.timing(keyprefix(cachekey), "produce", time.time() - start)
 
     def cacheFetch(self, cachekey, f_produce, *args, **kwargs):
-        if cachekey in self:
-            # _loginfo("CACHE: cacheFetch (in cache) key=%s"%cachekey)
-            cachedata = self[cachekey]
-        else:
+        self._load(cachekey)
+        self.lock.acquire()
+        try:
+            found = self._live(cachekey)
+            if found:
+                # _loginfo("CACHE: cacheFetch (in cache) key=%s"%cachekey)
+                cachedata = self._revalidate(cachekey, f_produce, args, kwargs)
+        finally:
+            self.lock.release()
+        if not found:
             # _loginfo("CACHE: cacheFetch (creating) key=%s"%cachekey)
-            cachedata, lifetime = f_produce(*args, **kwargs)
+            self.metrics.count(keyprefix(cachekey), "miss")
+            cachedata, lifetime = self._produce(cachekey, f_produce, args, kwargs)
             # _loginfo("CACHE: cacheFetch (finished creating) key=%s"%cachekey)
             if lifetime > 0:
                 self.insert(cachekey, lifetime, cachedata)
         return cachedata
 
     def lockedCacheFetch(self, cachekey, f_produce, *args, **kwargs):
-        # If the key already exists, return it immediately
-        if cachekey in self:
-            # _loginfo("CACHE: lockedCacheFetch (in cache) key=%s"%cachekey)
-            return self[cachekey]
-        else:
-            # Otherwise, if the 'wait' flag has been set for this key
-            if self.key_wait_get(cachekey):
-                # _loginfo("CACHE: lockedCacheFetch (waiting for flag) key=%s"%cachekey)
-                # Pick a random time to wait between 2 and 5 minutes, after which we'll ignore the flag
-                time_to_wait = self.wait_expiry
-                # Wait until the 'wait' flag is unset, or our timeout expires
-                while time_to_wait > 0 and self.key_wait_get(cachekey):
-                    time_to_wait -= self.wait_interval
-                    time.sleep(self.wait_interval)
-
-                # Once the wait is up, either the flag was unset and the data is now available
-                if cachekey in self:
-                    # _loginfo("CACHE: lockedCacheFetch (waited for flag, in cache) key=%s"%cachekey)
-                    return self[cachekey]
-                # Or the time expired, in which case we'll make an attempt to fetch it, hopefully more successfully
-                else:
-                    # _loginfo("CACHE: lockedCacheFetch (waited for flag, creating) key=%s"%cachekey)
-                    cachedata = None
-                    self.key_wait_set(cachekey, True)
+        """
+        Return the cached data for cachekey, producing it with f_produce if needed.
+        Only one thread produces a given key at a time; other threads asking for
+        the same key block until the producer finishes, and then get its value or
+        its exception. If the producer takes longer than wait_expiry, waiters give
+        up on it and produce the data themselves.
+        """
+        self._load(cachekey)
+        self.lock.acquire()
+        try:
+            # If the key already exists, return it immediately, refreshing it if stale
+            if self._live(cachekey):
+                # _loginfo("CACHE: lockedCacheFetch (in cache) key=%s"%cachekey)
+                return self._revalidate(cachekey, f_produce, args, kwargs)
+
+            # Otherwise join the thread already producing it, or become the producer
+            self.metrics.count(keyprefix(cachekey), "miss")
+            flight = self.inflight.get(cachekey, None)
+            producer = flight is None
+            if producer:
+                flight = self.inflight[cachekey] = _InFlight()
+        finally:
+            self.lock.release()
+
+        if not producer:
+            # _loginfo("CACHE: lockedCacheFetch (waiting for producer) key=%s"%cachekey)
+            start = time.time()
+            done = flight.done.wait(self.wait_expiry)
+            self.metrics.timing(keyprefix(cachekey), "wait", time.time() - start)
+            if done:
+                if flight.error is not None:
+                    raise flight.error
+                if flight.ok and not flight.pickled:
+                    return flight.value
+                if flight.ok:
                     try:
-                        cachedata, lifetime = f_produce(*args, **kwargs)
-                        if lifetime > 0:
-                            self.insert(cachekey, lifetime, cachedata)
-                    finally:
-                        self.key_wait_set(cachekey, False)
-                    return cachedata
+                        return pickle.loads(flight.value)
+                    except pickle.PickleError:
+                        _logwarn("CACHE: Unpickling error with key=%s" % cachekey)
+
+            # The producer is stuck or its value unusable, make an attempt
+            # ourselves, hopefully more successfully
+            # _loginfo("CACHE: lockedCacheFetch (waited for producer, creating) key=%s"%cachekey)
+            cachedata, lifetime = self._produce(cachekey, f_produce, args, kwargs)
+            if lifetime > 0:
+                self.insert(cachekey, lifetime, cachedata)
+            return cachedata
+
+        # _loginfo("CACHE: lockedCacheFetch (creating) key=%s"%cachekey)
+        return self._produceFlight(cachekey, flight, f_produce, args, kwargs)
 
-            # The data doesn't exist, and no other thread is currently making it
+    def _produceFlight(self, cachekey, flight, f_produce, args, kwargs):
+        # Produce and insert the data for a registered in-flight key, then
+        # hand the waiters the same private copy a cache hit would give
+        # them: mutable data is passed on pickled, reusing the pickle made
+        # for the cache entry if there is one.  If the data cannot be
+        # copied, the waiters produce it themselves.
+        produced = False
+        try:
+            cachedata, lifetime = self._produce(cachekey, f_produce, args, kwargs)
+            produced = True
+            entry = None
+            if lifetime > 0:
+                entry = self._insertEntry(cachekey, lifetime, cachedata)
+            if entry and entry[3]:
+                flight.value, flight.pickled = entry[2], True
+            elif self._immutable(cachedata):
+                flight.value = cachedata
             else:
-                # _loginfo("CACHE: lockedCacheFetch (creating) key=%s"%cachekey)
-                cachedata = None
-                self.key_wait_set(cachekey, True)
                 try:
-                    cachedata, lifetime = f_produce(*args, **kwargs)
-                    if lifetime > 0:
-                        self.insert(cachekey, lifetime, cachedata)
-                finally:
-                    self.key_wait_set(cachekey, False)
-                return cachedata
+                    flight.value = pickle.dumps(cachedata, pickle.HIGHEST_PROTOCOL)
+                    flight.pickled = True
+                except (pickle.PickleError, TypeError, AttributeError):
+                    _logwarn("CACHE: Pickling error with key=%s" % cachekey)
+                    return cachedata
+            flight.ok = True
+            return cachedata
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            # Wake the waiters whatever happened, so no thread is left
+            # hanging, nor silently gets nothing if the producer was aborted
+            if not produced and flight.error is None:
+                flight.error = RuntimeError("producer for key %s aborted" % cachekey)
+            self.lock.acquire()
+            try:
+                if self.inflight.get(cachekey, None) is flight:
+                    del self.inflight[cachekey]
+            finally:
+                self.lock.release()
+            flight.done.set()
 
     def asyncWorker(self, cachekey, f_produce, *args, **kwargs):
         """
-        Worker function for async threads. This fills data in a separate thread, if it doesn't already exist.
+        Worker function for the refresh pool. This fills data in a separate thread, if it doesn't already exist or is stale.
+        The refresh is registered as in flight, so lockedCacheFetch calls missing the key wait for it instead of producing it again.
         """
         # _loginfo("CACHE: asyncWorker key=%s"%cachekey)
-        if not cachekey in self:
-            try:
-                cachedata, lifetime = f_produce(*args, **kwargs)
-                if lifetime > 0:
-                    self.insert(cachekey, lifetime, cachedata)
-            except:
-                pass
+        self._load(cachekey)
+        self.lock.acquire()
+        try:
+            if self._fresh(cachekey) or cachekey in self.inflight:
+                return
+            flight = self.inflight[cachekey] = _InFlight()
+        finally:
+            self.lock.release()
+        try:
+            self._produceFlight(cachekey, flight, f_produce, args, kwargs)
+        except:
+            pass
 
     def asyncCacheFill(self, cachekey, f_produce, *args, **kwargs):
         """
-        Trigger a thread to try and asynchronously fill some data into the cache. Good for __init__ methods to prefill some information they require before request time.
+        Queue an asynchronous fill of some data into the cache on the refresh pool. Good for __init__ methods to prefill some information they require before request time.
         """
-        kwargs["cachekey"] = cachekey
-        kwargs["f_produce"] = f_produce
-        async_fill_thread = Thread(
-            name="asyncCacheFiller:%s" % cachekey,
-            target=self.asyncWorker,
-            args=args,
-            kwargs=kwargs,
-        )
-        async_fill_thread.start()
+        self.refresher.submit(cachekey, f_produce, args, kwargs)
+
+    def registerStats(self, stats):
+        """
+        Add the CacheStats of another cache to those reported by the stats page.
+        """
+        self.lock.acquire()
+        try:
+            self.extrastats.append(stats)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """
+        Return the cache statistics: per-prefix counters, bytes held and
+        latency histograms for this cache and every registered cache.
+        """
+        self.lock.acquire()
+        try:
+            extrastats = list(self.extrastats)
+            current = {
+                "items": len(self.cache),
+                "bytes": self.cachesize,
+                "itemlimit": self.itemlimit,
+                "sizelimit": self.sizelimit,
+                "inflight": len(self.inflight),
+                "refreshqueue": self.refresher.queue.qsize(),
+            }
+        finally:
+            self.lock.release()
+        summary = self.metrics.summary()
+        summary["current"] = current
+        return {"caches": [summary] + [s.summary() for s in extrastats]}
+
+
+class _CacheStatsPage(object):
+    """
+    Web application mounted at <baseUrl>/cache, serving the statistics of
+    an OverviewCache as JSON and nothing else of the cache.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    @expose
+    def stats(self, *args, **kwargs):
+        response.headers["Content-Type"] = "application/json"
+        return json.dumps(self.cache.stats()).encode()
 
 
 if __name__ == "__main__":
@@ -378,7 +1033,7 @@ if __name__ == "__main__":
             ops -= 1
         _loginfo("%s: finished" % name)
 
-    cache = OverviewCache(None, interval=1, wait_expiry=5, wait_interval=1)
+    cache = OverviewCache(None, interval=1, wait_expiry=5)
     threads = []
     for i in range(threadcount):
         tester = Thread(
@@ -12,18 +12,26 @@ from imp import get_suffixes
 from copy import deepcopy
 from html import escape
 from socket import gethostname
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread, Lock
 from cherrypy import expose, HTTPError, request, response, engine, log, tools, Tool
 from cherrypy.lib.static import serve_file
+from cherrypy.lib import cptools, httputil
 from Cheetah.Template import Template
 from Monitoring.Core.Utils.Common import _logerr, _logwarn, ParameterManager
 from io import StringIO
 from stat import *
 from jsmin import jsmin
 from http import client
-import pickle
+import pickle, gzip, uuid
 import sys, os, os.path, re, tempfile, time, inspect, logging, traceback, hashlib
-import json, base64
+import json, base64, urllib.parse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 _SESSION_REDIRECT = (
     "<html><head><script>location.replace('%s')</script></head>"
@@ -41,6 +49,174 @@ def extension(modules, what, *args):
     return None
 
 
+# -------------------------------------------------------------------
+class Session(dict):
+    """Session state dictionary which tracks what may have changed.
+
+    Assigning or deleting a top-level key marks it dirty, and so does
+    reading a mutable value (dict, list or set) with ``session[key]``
+    since the caller may modify it in place.  Reading with ``get`` is
+    assumed not to modify anything.  :meth:`snapshot` returns for the
+    session thread deep copies of only the dirty values.  Saving a
+    session after a typical request then costs in proportion to the
+    keys it touched rather than to the size of the session, and no
+    second copy of the session is kept in memory.
+
+    .. attribute:: dirty
+
+       Top-level keys which may differ from the last snapshot.  All the
+       keys of a new session are dirty."""
+
+    MUTABLE = (dict, list, set)
+    TRANSIENT = ("core.lock",)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.dirty = set(self.keys())
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, self.MUTABLE):
+            self.dirty.add(key)
+        return value
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.dirty.add(key)
+
+    def setdefault(self, key, default=None):
+        self.dirty.add(key)
+        return dict.setdefault(self, key, default)
+
+    def pop(self, key, *args):
+        self.dirty.add(key)
+        return dict.pop(self, key, *args)
+
+    def update(self, *args, **kwargs):
+        for key in dict(*args, **kwargs):
+            self.dirty.add(key)
+        dict.update(self, *args, **kwargs)
+
+    def snapshot(self):
+        """Return the changes since the last snapshot for saving: a plain
+        dictionary with copies of the dirty values, and the set of dirty
+        keys, which includes the deleted ones."""
+        keys = self.dirty.difference(self.TRANSIENT)
+        changed = dict(
+            (key, deepcopy(dict.__getitem__(self, key)))
+            for key in keys
+            if dict.__contains__(self, key)
+        )
+        self.dirty = set()
+        return changed, keys
+
+
+# -------------------------------------------------------------------
+class SessionSlot:
+    """Registry entry for one session.  The slot lock is the session lock,
+    also available as session["core.lock"]; it is held while the session
+    is loaded from disk and while a request uses the session.  A slot is
+    dead once it has been dropped from the registry."""
+
+    __slots__ = ("lock", "session", "dead")
+
+    def __init__(self, session=None):
+        self.lock = (session is not None and session.get("core.lock")) or Lock()
+        self.session = session
+        self.dead = False
+        if session is not None:
+            session["core.lock"] = self.lock
+
+
+class SessionRegistry:
+    """Sessions held in memory by the server, split into shards with
+    their own locks.  A shard lock is only held to look up, add or drop
+    a slot, never while a session is loaded from disk, so requests for
+    different sessions do not wait for each other.  Each shard keeps its
+    slots in order of last access, least recently used first, for
+    :meth:`reap`."""
+
+    def __init__(self, nshards=32):
+        self._shards = [(Lock(), OrderedDict()) for _ in range(nshards)]
+
+    def _shard(self, name):
+        return self._shards[hash(name) % len(self._shards)]
+
+    def slot(self, name):
+        """Return the slot for NAME, creating an empty one if needed."""
+        lock, slots = self._shard(name)
+        lock.acquire()
+        try:
+            slot = slots.get(name, None)
+            if slot is None:
+                slot = slots[name] = SessionSlot()
+            else:
+                slots.move_to_end(name)
+            return slot
+        finally:
+            lock.release()
+
+    def add(self, name, session):
+        """Register SESSION under NAME, unless it already is.  A session
+        purged while still in use is put back with its existing lock."""
+        lock, slots = self._shard(name)
+        lock.acquire()
+        try:
+            slot = slots.get(name, None)
+            if slot is None or slot.session is not session:
+                slots[name] = SessionSlot(session)
+        finally:
+            lock.release()
+
+    def drop(self, name, slot):
+        """Drop SLOT from the registry if it is still the one for NAME."""
+        lock, slots = self._shard(name)
+        lock.acquire()
+        try:
+            slot.dead = True
+            if slots.get(name, None) is slot:
+                del slots[name]
+        finally:
+            lock.release()
+
+    def __len__(self):
+        return sum(len(slots) for lock, slots in self._shards)
+
+    def reap(self, older, limit=None):
+        """Drop from memory sessions last used before time OLDER, and the
+        least recently used ones beyond LIMIT sessions in total.  Sessions
+        locked by a request are left alone; every session in memory has
+        been handed to the session thread for saving, so a dropped one is
+        reloaded from disk on next use.  Returns the names dropped."""
+        reaped = []
+        keep = limit and -(-limit // len(self._shards))
+        for lock, slots in self._shards:
+            lock.acquire()
+            try:
+                for _ in range(len(slots)):
+                    name, slot = next(iter(slots.items()))
+                    if (
+                        slot.session is not None
+                        and slot.session["core.stamp"] >= older
+                        and (keep is None or len(slots) <= keep)
+                    ):
+                        break
+                    if slot.session is None or not slot.lock.acquire(False):
+                        slots.move_to_end(name)
+                        continue
+                    del slots[name]
+                    slot.dead = True
+                    slot.lock.release()
+                    reaped.append(name)
+            finally:
+                lock.release()
+        return reaped
+
+
 # -------------------------------------------------------------------
 class SessionThread(Thread):
     """Background thread for managing the server's sessions.
@@ -51,12 +227,23 @@ class SessionThread(Thread):
     modifiation to disk.
 
     The server runs this separate thread to save modified sessions back
-    to disk in python's pickled format.  It is essential the per-session
-    data is of limited size as pickling is slow.  The output is done in
-    as safe a manner as possible to avoid data loss if the server
-    crashes or is restarted, and even if it is terminated forcefully
-    with SIGKILL.  Modified sessions are written out about once a
-    second.
+    to disk in python's pickled format.  The thread is given only the
+    top-level keys a session marked dirty since its previous save.
+    Each session is stored as a full snapshot file plus an append-only
+    journal next to it.  Once a snapshot exists, saving a session only
+    appends a record of the changed and deleted keys, so the cost of a
+    save is proportional to the size of the change.  The journal is
+    compacted into a new snapshot, built from the files on disk and the
+    pending changes, after .maxrecords records or when the thread no
+    longer remembers the session.  No copy of whole sessions is kept in
+    memory by the thread.  The output is
+    done in as safe a manner as possible to avoid data loss if the
+    server crashes or is restarted, and even if it is terminated
+    forcefully with SIGKILL: every snapshot carries a new generation
+    tag and journal records carry the tag of the snapshot they apply
+    to, so a journal left behind by a crash between replacing the
+    snapshot and removing the journal is ignored.  Modified sessions
+    are written out about once a second.
 
     .. attribute:: _stopme
 
@@ -68,62 +255,293 @@ class SessionThread(Thread):
 
     .. attribute:: _save
 
-       A dictionary of sessions that must be saved."""
+       A dictionary of the sessions that must be saved, as [changed,
+       keys]: the new values of the changed keys, and all the changed
+       keys including the deleted ones.
+
+    .. attribute:: _saving
+
+       The sessions taken from ._save currently being written out.
+
+    .. attribute:: _persisted
+
+       For each recently saved session, [generation, nrecords, stamp]:
+       the generation of its snapshot, the number of records in its
+       journal and when it was last written.  Entries are dropped when
+       the session is evicted from memory, see :meth:`forget`.
+
+    .. attribute:: maxrecords
+
+       Number of journal records after which a session is compacted."""
+
+    maxrecords = 100
 
     def __init__(self, path):
         Thread.__init__(self, name="GUI session thread")
         self._lock = Lock()
+        self._iolock = Lock()
         self._stopme = False
         self._path = path
         self._save = {}
+        self._saving = {}
+        self._persisted = {}
+
+    @staticmethod
+    def _merge(older, newer):
+        """Return the [changed, keys] changes OLDER followed by NEWER."""
+        changed = dict(older[0])
+        for k in newer[1]:
+            if k in newer[0]:
+                changed[k] = newer[0][k]
+            else:
+                changed.pop(k, None)
+        return [changed, older[1] | newer[1]]
+
+    @staticmethod
+    def _apply(data, changes):
+        """Apply [changed, keys] CHANGES to session DATA."""
+        for k in changes[1]:
+            if k in changes[0]:
+                data[k] = changes[0][k]
+            else:
+                data.pop(k, None)
 
-    def save(self, data):
-        """Record a session for saving.  The session's data in VALUE will
-        become the property of this thread exclusively."""
+    def save(self, name, changed, keys):
+        """Record changes to session NAME for saving: the new values of the
+        CHANGED keys, and all the changed KEYS including the deleted ones.
+        The values will become the property of this thread exclusively."""
         self._lock.acquire()
-        self._save[data["core.name"]] = data
+        pending = self._save.get(name, None)
+        changes = [changed, set(keys)]
+        self._save[name] = (pending and self._merge(pending, changes)) or changes
         self._lock.release()
 
+    def forget(self, names):
+        """Forget the sessions NAMES evicted from memory.  Their next save
+        compacts them into a new snapshot."""
+        self._iolock.acquire()
+        try:
+            for name in names:
+                self._persisted.pop(name, None)
+        finally:
+            self._iolock.release()
+
     def stop(self):
         """Tell the thread to stop after it has flushed all the data to disk."""
         self._lock.acquire()
         self._stopme = True
         self._lock.release()
 
+    def load(self, name):
+        """Read session NAME back from disk, replaying its journal over the
+        last snapshot.  Returns None if there is no such session.  A record
+        truncated by a crash at the end of the journal is ignored.  Changes
+        still waiting to be saved are applied on top."""
+        path = self._path + "/" + name
+        self._iolock.acquire()
+        try:
+            self._lock.acquire()
+            pending = [
+                c for c in (self._saving.get(name), self._save.get(name)) if c
+            ]
+            self._lock.release()
+            if not os.path.exists(path):
+                return None
+            data = self._read(path)
+            for changes in pending:
+                self._apply(data, deepcopy(changes))
+            return data
+        finally:
+            self._iolock.release()
+
+    @staticmethod
+    def _read(path):
+        """Read the session at PATH: the snapshot, and the records of its
+        journal which belong to the snapshot's generation."""
+        generation = None
+        with open(path, "rb") as _f:
+            data = (os.fstat(_f.fileno()).st_size and pickle.load(_f)) or {}
+            try:
+                generation = pickle.load(_f)
+            except EOFError:
+                pass
+        if os.path.exists(path + ".journal"):
+            with open(path + ".journal", "rb") as _f:
+                while True:
+                    try:
+                        record = pickle.load(_f)
+                    except Exception:
+                        break
+                    if len(record) == 2:
+                        record = (None,) + tuple(record)
+                    if record[0] != generation:
+                        continue
+                    data.update(record[1])
+                    for k in record[2]:
+                        data.pop(k, None)
+        return data
+
+    def _writeSnapshot(self, name, data):
+        """Write a full snapshot of session NAME with a new generation and
+        drop its journal.  Returns the generation, or None on failure."""
+        path = self._path + "/" + name
+        tmppath = path + ".tmp"
+        generation = uuid.uuid4().hex
+        with open(tmppath, "wb") as _f:
+            pickle.dump(data, _f)
+            pickle.dump(generation, _f)
+
+        try:
+            os.rename(tmppath, path)
+        except os.error:
+            return None
+
+        try:
+            os.remove(path + ".journal")
+        except os.error:
+            pass
+        return generation
+
+    def _appendJournal(self, name, generation, changes):
+        """Append CHANGES to the journal of session NAME.  Returns False
+        if there was nothing to append."""
+        changed, keys = changes
+        if not keys:
+            return False
+        deleted = [k for k in keys if k not in changed]
+        with open(self._path + "/" + name + ".journal", "ab") as _f:
+            _f.write(pickle.dumps((generation, changed, deleted)))
+        return True
+
+    def _write(self, name, changes):
+        """Save changes to one session to disk, as a journal record when
+        possible, otherwise as a new snapshot."""
+        self._iolock.acquire()
+        try:
+            persisted = self._persisted.get(name, None)
+            if persisted and persisted[1] < self.maxrecords:
+                if self._appendJournal(name, persisted[0], changes):
+                    persisted[1] += 1
+                persisted[2] = time.time()
+                return True
+
+            path = self._path + "/" + name
+            data = (os.path.exists(path) and self._read(path)) or {}
+            self._apply(data, changes)
+            generation = self._writeSnapshot(name, data)
+            if generation is None:
+                return False
+            self._persisted[name] = [generation, 0, time.time()]
+            return True
+        finally:
+            self._iolock.release()
+
     def run(self):
         """The thread run loop.  Checks for dirty sessions about once a
         second, and if there are any, grabs the list of currently dirty
-        sessions and starts writing them to disk in pickled format.
+        sessions and writes their changes to disk in pickled format.
         Manipulates session files as safely as possible."""
+        lastprune = time.time()
         while True:
             self._lock.acquire()
             stopme = self._stopme
-            save = self._save
+            save = self._saving = self._save
             self._save = {}
             self._lock.release()
-            for name, data in save.items():
-                path = self._path + "/" + name
-                tmppath = path + ".tmp"
-                with open(tmppath, "wb") as _f:
-                    pickle.dump(data, _f)
-
-                try:
-                    os.remove(path)
-                except os.error:
-                    pass
-
-                try:
-                    os.rename(tmppath, path)
-                except os.error:
+            for name, changes in save.items():
+                if not self._write(name, changes):
                     self._lock.acquire()
-                    self._save[name] = data
+                    pending = self._save.get(name, None)
+                    self._save[name] = (
+                        pending and self._merge(changes, pending)
+                    ) or changes
                     self._lock.release()
+            self._lock.acquire()
+            self._saving = {}
+            self._lock.release()
+
+            # Forget what was written for sessions idle for a while; their
+            # next save writes a full snapshot.
+            now = time.time()
+            if now - lastprune > 60:
+                lastprune = now
+                self._iolock.acquire()
+                for name in [
+                    k for k, v in self._persisted.items() if v[2] < now - 900
+                ]:
+                    del self._persisted[name]
+                self._iolock.release()
 
             if stopme:
                 break
             time.sleep(1)
 
 
+# -------------------------------------------------------------------
+class SessionReaper(Thread):
+    """Background thread dropping idle sessions from the server memory.
+
+    Every .interval seconds the reaper evicts from the server's
+    :class:`SessionRegistry` the sessions not used for .idle seconds,
+    and the least recently used ones beyond .limit sessions if a limit
+    is set.  The registry keeps sessions in access order so only the
+    evicted sessions are visited.  Evicted sessions remain on disk, and
+    are also forgotten by the .sessionthread, so nothing is left in
+    memory for them."""
+
+    def __init__(
+        self, sessions, idle=900, limit=None, interval=10, sessionthread=None
+    ):
+        Thread.__init__(self, name="GUI session reaper")
+        self.daemon = True
+        self.sessions = sessions
+        self.sessionthread = sessionthread
+        self.idle = idle
+        self.limit = limit
+        self.interval = interval
+        self._stopme = False
+
+    def stop(self):
+        """Tell the thread to stop."""
+        self._stopme = True
+
+    def run(self):
+        """The thread run loop."""
+        while not self._stopme:
+            try:
+                reaped = self.sessions.reap(time.time() - self.idle, self.limit)
+                if self.sessionthread:
+                    self.sessionthread.forget(reaped)
+            except Exception as e:
+                _logerr("FAILURE: cannot reap sessions: " + str(e))
+            time.sleep(self.interval)
+
+
+# -------------------------------------------------------------------
+def _cssmin(text):
+    """Minify CSS: strip comments and redundant white space."""
+    return re.sub(
+        r"\n+",
+        "\n",
+        re.sub(
+            re.compile(r"\s+$", re.M),
+            "",
+            re.sub(
+                re.compile(r"^[ \t]+", re.M),
+                " ",
+                re.sub(r"[ \t]+", " ", re.sub(r"/\*(?:.|[\r\n])*?\*/", "", text)),
+            ),
+        ),
+    )
+
+
+# Versions of the minifiers, part of the key of cached minified fragments.
+# Bump the CSS one whenever _cssmin changes.
+_MINIFIER_VERSION = {
+    "css": 1,
+    "js": getattr(sys.modules.get(jsmin.__module__), "__version__", "unknown"),
+}
+
 # -------------------------------------------------------------------
 tools.params = ParameterManager()
 
@@ -168,6 +586,21 @@ class Server:
 
        List of data sources attached to this service.
 
+    .. attribute:: plothooks
+
+       Dictionary from "plothook" name to the source handling it, for
+       plotfairy and the sources combining other sources' objects.
+
+    .. attribute:: jsonhooks
+
+       Dictionary from "jsonhook" name to the source handling it.
+
+    .. attribute:: plotpool
+
+       Thread pool rendering the images of .plotbatch() requests, sized
+       with the ``plot_batch_threads`` entry of ``server.options``
+       (default 8, the default number of render processes).
+
     .. attribute:: sessiondir
 
        Directory where session data is kept.
@@ -184,16 +617,34 @@ class Server:
 
     .. attribute:: templates
 
-       Cheetah template files in .contentpath.
+       Cheetah template files in .contentpath, each a list of the file
+       name, modification time, source text and compiled template class
+       or None if not yet compiled.
+
+    .. attribute:: templatecheck
+
+       Seconds between checks for modified template files, set with the
+       ``template_check`` entry of ``server.options`` (default 5).
 
     .. attribute:: sessions
 
-       Currently active sessions.
+       Currently active sessions, a :class:`SessionRegistry`.
 
     .. attribute:: sessionthread
 
        Background thread for saving sessions.
 
+    .. attribute:: minidir
+
+       Directory where minified CSS and JavaScript fragments are cached.
+
+    .. attribute:: sessionreaper
+
+       Background thread dropping idle sessions from memory, configured
+       with the ``session_idle`` (seconds, default 900) and
+       ``session_limit`` (number of sessions, default unlimited)
+       entries of ``server.options``.
+
     .. attribute:: lock
 
        Lock for modifying variable data.
@@ -217,6 +668,10 @@ class Server:
         self.services = cfg.services
         self.serviceName = cfg.serviceName
         self.templates = {}
+        self.templatecheck = getattr(cfg, "options", {}).get("template_check", 5)
+        self._templatecheck = time.time() + self.templatecheck
+        self._pageparams = None
+        self._bundles = None
         self.css = []
         self.js = []
 
@@ -228,6 +683,8 @@ class Server:
 
         self.baseUrl = cfg.baseUrl
         self.sessiondir = cfg.serverDir + "/sessions"
+        self.minidir = cfg.serverDir + "/minified"
+        self._miniused = set()
         self.logdir = cfg.logFile.rsplit("/", 1)[0]
         self.title = cfg.title
         for file in os.listdir(self.contentpath + "/templates"):
@@ -240,6 +697,7 @@ class Server:
                         filename,
                         os.stat(filename)[ST_MTIME],
                         _f.read(),
+                        None,
                     ]
 
         self._yui = os.path.join(os.getenv("YUI_ROOT"), "build")
@@ -255,8 +713,17 @@ class Server:
         self._addJSFragment("%s/javascript/Core/Utils.js" % self.contentpath)
         self._addJSFragment("%s/javascript/Core/Core.js" % self.contentpath)
 
-        self.sessions = {}
+        self.sessions = SessionRegistry()
         self.sessionthread = SessionThread(self.sessiondir)
+        self.plotpool = ThreadPoolExecutor(
+            getattr(cfg, "options", {}).get("plot_batch_threads", 8)
+        )
+        self.sessionreaper = SessionReaper(
+            self.sessions,
+            getattr(cfg, "options", {}).get("session_idle", 900),
+            getattr(cfg, "options", {}).get("session_limit", None),
+            sessionthread=self.sessionthread,
+        )
         self.extensions = [
             extension(modules, e[0], self, *e[1]) for e in cfg.extensions
         ]
@@ -264,6 +731,13 @@ class Server:
             extension(modules, s[0] + "Source", self, cfg.serverDir + "/" + s[1], *s[2])
             for s in cfg.sources
         ]
+        self.plothooks = {}
+        self.jsonhooks = {}
+        for s in self.sources:
+            if getattr(s, "plothook", None):
+                self.plothooks.setdefault(s.plothook, s)
+            if getattr(s, "jsonhook", None):
+                self.jsonhooks.setdefault(s.jsonhook, s)
         self.workspaces = [
             extension(modules, w[0] + "Workspace", self, *w[1]) for w in cfg.workspaces
         ]
@@ -273,6 +747,7 @@ class Server:
                 w.customise()
 
         self._addJSFragment("%s/javascript/Core/End.js" % self.contentpath)
+        self._pruneMinified()
         with open(cfgfile) as _f:
             self._addChecksum(None, cfgfile, _f.read())
         for name, m in sys.modules.items():
@@ -310,6 +785,9 @@ class Server:
 
         self.sessionthread.start()
         engine.subscribe("stop", self.sessionthread.stop)
+        self.sessionreaper.start()
+        engine.subscribe("stop", self.sessionreaper.stop)
+        engine.subscribe("stop", lambda: self.plotpool.shutdown(wait=False))
 
     def _addChecksum(self, modulename, file, data):
         """Add info for a file into the internal checksum table."""
@@ -336,17 +814,61 @@ class Server:
             fileinfo[1] = mtime
             with open(fileinfo[0]) as _f:
                 fileinfo[2] = _f.read()
+            fileinfo[3:] = [None]
         self.lock.release()
         return fileinfo[2]
 
+    def _template(self, name):
+        """Return the compiled cheetah template class for template NAME.
+        Templates are compiled once and recompiled only after a change to
+        the template file, which is checked for every .templatecheck
+        seconds rather than on each request."""
+        now = time.time()
+        if now >= self._templatecheck:
+            self._templatecheck = now + self.templatecheck
+            for key in self.templates:
+                self._maybeRefreshFile(self.templates, key)
+
+        fileinfo = self.templates[name]
+        compiled = fileinfo[3]
+        if compiled is None:
+            compiled = fileinfo[3] = Template.compile(source=fileinfo[2])
+        return compiled
+
+    def _pageParams(self):
+        """Return the CSS and JavaScript parameters of the master HTML
+        page, joined once after every change to the fragments.  Besides
+        the inline text the pages get content-hashed URLs of the same
+        bundles, served precompressed from .bundle()."""
+        params = self._pageparams
+        if params is None:
+            css = "".join(x[1] for x in self.css)
+            js = "".join(x[1] for x in self.js)
+            bundles = self._bundles = {
+                "css": self._makeBundle(css),
+                "js": self._makeBundle(js),
+            }
+            params = self._pageparams = {
+                "CSS": css,
+                "JAVASCRIPT": js,
+                "CSS_URL": "%s/bundle/%s.css" % (self.baseUrl, bundles["css"][0]),
+                "JAVASCRIPT_URL": "%s/bundle/%s.js" % (self.baseUrl, bundles["js"][0]),
+            }
+        return params
+
+    def _makeBundle(self, text):
+        """Make a static bundle of TEXT: returns the content hash and a
+        dictionary of the content for each supported encoding."""
+        data = text.encode("utf-8")
+        variants = {"identity": data, "gzip": gzip.compress(data, 9)}
+        if brotli:
+            variants["br"] = brotli.compress(data)
+        return (hashlib.sha1(data).hexdigest()[:20], variants)
+
     def _templatePage(self, name, variables):
         """Generate HTML page from cheetah template and variables."""
-        template = self._maybeRefreshFile(self.templates, name)
-        params = {
-            "CSS": "".join(x[1] for x in self.css),
-            "JAVASCRIPT": "".join(x[1] for x in self.js),
-        }
-        return str(Template(template, searchList=[variables, params]))
+        template = self._template(name)
+        return str(template(searchList=[variables, self._pageParams()]))
 
     def _noResponseCaching(self):
         """Tell the browser not to cache this response."""
@@ -355,6 +877,77 @@ class Server:
         response.headers["Cache-Control"] = (
             "no-store, no-cache, must-revalidate, post-check=0, pre-check=0"
         )
+        response.headers.pop("ETag", None)
+        response.headers.pop("Last-Modified", None)
+
+    def _validateResponse(self, hooks, args, kwargs):
+        """Set cache validators for a plot or json response if the source
+        named by the first of ARGS in HOOKS provides them, and answer a
+        matching conditional request with 304 Not Modified.  Sources with
+        immutable content define a validator(*args, **kwargs) method
+        returning an (etag, mtime) tuple, or None if the response must
+        not be cached.  Returns True if the validators were set."""
+        source = len(args) >= 1 and hooks.get(args[0], None)
+        validator = source and getattr(source, "validator", None)
+        try:
+            tag = validator and validator(*args[1:], **kwargs)
+        except Exception:
+            tag = None
+        if not tag:
+            return False
+
+        response.headers["ETag"] = '"%s"' % tag[0]
+        response.headers["Last-Modified"] = httputil.HTTPDate(tag[1])
+        response.headers["Cache-Control"] = "private, max-age=0, must-revalidate"
+        cptools.validate_etags()
+        cptools.validate_since()
+        return True
+
+    def _staticResponseCaching(self):
+        """Let the browser keep static content for a day.  The files are
+        served with their modification time so the browser can check if
+        they have changed after that."""
+        response.headers["Cache-Control"] = "public, max-age=86400"
+
+    def _minified(self, kind, text, minify):
+        """Return TEXT minified with MINIFY.  Results are kept on disk in
+        .minidir keyed by the content hash and minifier version, so a
+        restarted server only minifies fragments which have changed."""
+        key = hashlib.sha1(
+            ("%s:%s:%s\n" % (kind, _MINIFIER_VERSION[kind], text)).encode("utf-8")
+        ).hexdigest()
+        self._miniused.add(key)
+        path = "%s/%s.%s" % (self.minidir, key, kind)
+        try:
+            with open(path, encoding="utf-8") as _f:
+                return _f.read()
+        except (IOError, OSError):
+            pass
+
+        result = minify(text)
+        try:
+            if not os.path.isdir(self.minidir):
+                os.makedirs(self.minidir)
+            tmppath = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmppath, "w", encoding="utf-8") as _f:
+                _f.write(result)
+            os.rename(tmppath, path)
+        except (IOError, OSError) as e:
+            _logwarn("cannot cache minified %s fragment: %s" % (kind, str(e)))
+        return result
+
+    def _pruneMinified(self):
+        """Remove cached minified fragments not used by this server."""
+        try:
+            files = os.listdir(self.minidir)
+        except (IOError, OSError):
+            return
+        for file in files:
+            if file.split(".", 1)[0] not in self._miniused:
+                try:
+                    os.remove(self.minidir + "/" + file)
+                except (IOError, OSError):
+                    pass
 
     def _addCSSFragment(self, filename):
         """Add a piece of CSS to the master HTML page."""
@@ -383,22 +976,9 @@ class Server:
                         text,
                     ),
                 )
-            clean = re.sub(
-                r"\n+",
-                "\n",
-                re.sub(
-                    re.compile(r"\s+$", re.M),
-                    "",
-                    re.sub(
-                        re.compile(r"^[ \t]+", re.M),
-                        " ",
-                        re.sub(
-                            r"[ \t]+", " ", re.sub(r"/\*(?:.|[\r\n])*?\*/", "", text)
-                        ),
-                    ),
-                ),
-            )
+            clean = self._minified("css", text, _cssmin)
             self.css += [(filename, "\n" + clean + "\n")]
+            self._pageparams = None
 
     def _addJSFragment(self, filename, minimise=True):
         """Add a piece of javascript to the master HTML page."""
@@ -406,8 +986,9 @@ class Server:
             with open(filename) as _f:
                 text = _f.read()
             if minimise:
-                text = jsmin(text)
+                text = self._minified("js", text, jsmin)
             self.js += [(filename, "\n" + text + "\n")]
+            self._pageparams = None
 
     # -----------------------------------------------------------------
     # Session methods.
@@ -422,41 +1003,48 @@ class Server:
         session data, otherwise None.  Locks the session before returning
         it, making sure all other threads have released the session.  The
         caller _MUST_ release the session lock before the HTTP request
-        handling returns, or the next access to the session will hang."""
-        s = None
-        if re.match("^[-A-Za-z0-9_]+$", name):
-            self.lock.acquire()
-            if name not in self.sessions:
-                path = "%s/%s" % (self.sessiondir, name)
-                if os.path.exists(path):
-                    try:
-                        self.sessions[name] = pickle.load(open(path, "rb"))
-                    except Exception as e:
-                        _logerr("FAILURE: cannot load session data: " + str(e))
-
-            s = self.sessions.get(name, None)
-            self.lock.release()
-
-            if s:
-                current = self._sessionClientData()
-                if s["core.clientid"] == current and s["core.name"] == name:
-                    if "core.lock" not in s:
-                        s["core.lock"] = Lock()
-                    s["core.lock"].acquire()
-                    s["core.stamp"] = time.time()
-                else:
-                    s = None
+        handling returns, or the next access to the session will hang.
+
+        Only the registry shard is locked for the lookup; a session not
+        yet in memory is loaded from disk under its own session lock."""
+        if not re.match("^[-A-Za-z0-9_]+$", name):
+            return None
+
+        while True:
+            slot = self.sessions.slot(name)
+            slot.lock.acquire()
+            if not slot.dead:
+                break
+            slot.lock.release()
+
+        if slot.session is None:
+            data = None
+            try:
+                data = self.sessionthread.load(name)
+            except Exception as e:
+                _logerr("FAILURE: cannot load session data: " + str(e))
+            if not data:
+                self.sessions.drop(name, slot)
+                slot.lock.release()
+                return None
+            slot.session = Session(data)
+            slot.session.dirty = set()
+            slot.session["core.lock"] = slot.lock
+
+        s = slot.session
+        current = self._sessionClientData()
+        if s["core.clientid"] != current or s["core.name"] != name:
+            slot.lock.release()
+            return None
+
+        s["core.stamp"] = time.time()
         return s
 
     def _saveSession(self, session):
         """Save the SESSION state."""
-        self.lock.acquire()
         session["core.stamp"] = time.time()
-        self.sessions[session["core.name"]] = session
-        self.lock.release()
-        self.sessionthread.save(
-            dict((k, deepcopy(session[k])) for k in session.keys() if k != "core.lock")
-        )
+        self.sessions.add(session["core.name"], session)
+        self.sessionthread.save(session["core.name"], *session.snapshot())
 
     def _releaseSession(self, session):
         """Release the SESSION for use by other threads."""
@@ -465,14 +1053,6 @@ class Server:
     def _newSession(self, workspace):
         """Create and initialise a new session with some default workspace.
         This just initialises a session; it will not become locked."""
-        # Before creating a new one, purge from memory sessions that have
-        # not been used for 15 minutes, to avoid building up memory use.
-        self.lock.acquire()
-        old = time.time() - 900
-        for key in [k for k, s in self.sessions.items() if s["core.stamp"] < old]:
-            del self.sessions[key]
-        self.lock.release()
-
         # Generate a new session key.
         (fd, path) = tempfile.mkstemp("", "", self.sessiondir)
         sessionid = (path.split("/"))[-1]
@@ -481,7 +1061,7 @@ class Server:
         # Build session data.  We record:
         #  - client data for later verification
         #  - which workspace we are in
-        session = {}
+        session = Session()
         session["core.name"] = sessionid
         session["core.clientid"] = self._sessionClientData()
         session["core.public"] = False
@@ -512,7 +1092,7 @@ class Server:
             if getattr(s, "prepareSession", None):
                 s.prepareSession(session)
 
-        # Save the pickled session state file.
+        # Save the session state to disk.
         self._saveSession(session)
 
         # Return the final component of the session path.
@@ -557,8 +1137,44 @@ class Server:
         """Access our own static content."""
         if len(args) != 1 or not re.match(r"^[-a-z_]+\.(png|gif|svg)$", args[0]):
             return self._invalidURL()
+        self._staticResponseCaching()
         return serve_file(self.contentpath + "/images/" + args[0])
 
+    @expose
+    @tools.params()
+    def bundle(self, *args, **kwargs):
+        """Access the master page CSS and JavaScript bundles.  The URL
+        contains the content hash so responses can be cached forever; a
+        stale hash, for example from a page loaded before a restart, gets
+        the current bundle but uncached."""
+        m = len(args) == 1 and re.match(r"^([0-9a-f]+)\.(css|js)$", args[0])
+        if not m:
+            return self._invalidURL()
+
+        self._pageParams()
+        tag, variants = self._bundles[m.group(2)]
+        response.headers["Content-Type"] = (
+            m.group(2) == "css" and "text/css" or "application/javascript"
+        )
+        response.headers["Vary"] = "Accept-Encoding"
+        if m.group(1) != tag:
+            self._noResponseCaching()
+        else:
+            response.headers["ETag"] = '"%s"' % tag
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+            cptools.validate_etags()
+
+        accept = [
+            e.split(";")[0].strip()
+            for e in request.headers.get("Accept-Encoding", "").split(",")
+            if not re.search(r";\s*q=0(\.0*)?\s*$", e)
+        ]
+        for encoding in ("br", "gzip"):
+            if encoding in variants and encoding in accept:
+                response.headers["Content-Encoding"] = encoding
+                return variants[encoding]
+        return variants["identity"]
+
     @expose
     @tools.params()
     def yui(self, *args, **kwargs):
@@ -566,6 +1182,7 @@ class Server:
         path = "/".join(args)
         if not re.match(r"^[-a-z_/]+\.(png|gif|js|css)$", path):
             return self._invalidURL()
+        self._staticResponseCaching()
         return serve_file(self._yui + "/" + path)
 
     @expose
@@ -575,6 +1192,7 @@ class Server:
         path = "/".join(args)
         if not (self._extjs and re.match(r"^[-a-z_/]+\.(png|gif|js|css)$", path)):
             return self._invalidURL()
+        self._staticResponseCaching()
         return serve_file(self._extjs + "/" + path)
 
     @expose
@@ -584,6 +1202,7 @@ class Server:
         path = "/".join(args)
         if not (self._jsroot):
             return self._invalidURL()
+        self._staticResponseCaching()
         return serve_file(self._jsroot + "/" + path)
 
     @expose
@@ -593,6 +1212,7 @@ class Server:
         path = "/".join(args)
         if not (self._d3 and re.match(r"^[-a-z_/0-9\.]+\.(png|gif|js|css)$", path)):
             return self._invalidURL()
+        self._staticResponseCaching()
         return serve_file(self._d3 + "/" + path)
 
     # -----------------------------------------------------------------
@@ -638,12 +1258,10 @@ class Server:
     @tools.params()
     def jsrootfairy(self, *args, **kwargs):
         try:
-            if len(args) >= 1:
-                for s in self.sources:
-                    if getattr(s, "jsonhook", None) == args[0]:
-                        kwargs["jsroot"] = "true"
-                        data = s.getJson(*args[1:], **kwargs)
-                        return data
+            if len(args) >= 1 and args[0] in self.jsonhooks:
+                kwargs["jsroot"] = "true"
+                data = self.jsonhooks[args[0]].getJson(*args[1:], **kwargs)
+                return data
         except Exception as e:
             o = StringIO()
             traceback.print_exc(file=o)
@@ -666,21 +1284,20 @@ class Server:
         value of argument 'formatted' = true insread of pure JSON whole
         HTML page is returned.  The rest of the processing is given over
         to the hook."""
+        self._validateResponse(self.jsonhooks, args, kwargs)
         try:
             if len(args) >= 1:
-                for s in self.sources:
-                    if getattr(s, "jsonhook", None) == args[0]:
-                        data = s.getJson(*args[1:], **kwargs)
-                        if kwargs.get("formatted") == "true":
-                            template = self._maybeRefreshFile(self.templates, "json")
-                            variables = {
-                                "TITLE": "JSON represetation of histogram",
-                                "JSON": data,
-                            }
-                            return str(Template(template, searchList=[variables]))
-                        else:
-                            return data
-                        break
+                if args[0] in self.jsonhooks:
+                    data = self.jsonhooks[args[0]].getJson(*args[1:], **kwargs)
+                    if kwargs.get("formatted") == "true":
+                        template = self._template("json")
+                        variables = {
+                            "TITLE": "JSON represetation of histogram",
+                            "JSON": data,
+                        }
+                        return str(template(searchList=[variables]))
+                    else:
+                        return data
                 # if not found any...
                 return (
                     "JSON format of " + args[0] + " source plot is not supported yet."
@@ -704,18 +1321,19 @@ class Server:
         """General session-independent access path for dynamic images.
         The first subdirectory argument contains the name of the
         "source plot hook" able to handle the plotting request.
-        The rest of the processing is given over to the hook."""
+        The rest of the processing is given over to the hook.  Responses
+        are not cached by the browser unless the source provides cache
+        validators, see _validateResponse()."""
+        validated = self._validateResponse(self.plothooks, args, kwargs)
         try:
-            if len(args) >= 1:
-                for s in self.sources:
-                    if getattr(s, "plothook", None) == args[0]:
-                        (type, data) = s.plot(*args[1:], **kwargs)
-                        if type != None:
-                            self._noResponseCaching()
-                            response.headers["Content-Length"] = str(len(data))
-                            response.headers["Content-Type"] = type
-                            return data
-                        break
+            if len(args) >= 1 and args[0] in self.plothooks:
+                (type, data) = self.plothooks[args[0]].plot(*args[1:], **kwargs)
+                if type != None:
+                    if not validated:
+                        self._noResponseCaching()
+                    response.headers["Content-Length"] = str(len(data))
+                    response.headers["Content-Type"] = type
+                    return data
         except Exception as e:
             o = StringIO()
             traceback.print_exc(file=o)
@@ -730,6 +1348,71 @@ class Server:
             self.contentpath + "/images/missing.png", content_type="image/png"
         )
 
+    @expose
+    @tools.params()
+    def plotbatch(self, *args, **kwargs):
+        """Session-independent access path for many dynamic images at
+        once, for example all the cells of a layout.  The only path
+        argument is the "source plot hook" as for plotfairy.  Each "obj"
+        argument is the rest of a plotfairy path, optionally followed by
+        "?" and URL encoded render options of that image only, which
+        replace the shared ones of the same name; this is how hooks which
+        take an "obj" option of their own, such as overlays, get it.  All
+        other arguments are render options shared by all the images.  The
+        images are rendered in parallel and returned as a multipart/mixed
+        response with one part per object, in order, with the "obj"
+        argument as the part's Content-Location.  Images which cannot be
+        produced are replaced with the "missing" image."""
+        objs = kwargs.pop("obj", [])
+        if isinstance(objs, str):
+            objs = [objs]
+        if (
+            len(args) != 1
+            or args[0] not in self.plothooks
+            or len(objs) > 500
+            or [o for o in objs if not isinstance(o, str) or re.search(r"[\r\n]", o)]
+        ):
+            return self._invalidURL()
+
+        source = self.plothooks[args[0]]
+
+        def render(obj):
+            (path, _, query) = obj.partition("?")
+            options = dict(kwargs)
+            for (k, v) in urllib.parse.parse_qs(query, keep_blank_values=True).items():
+                options[k] = v[0] if len(v) == 1 else v
+            try:
+                (type, data) = source.plot(*path.split("/"), **options)
+                if type != None:
+                    return (type, data)
+            except Exception as e:
+                o = StringIO()
+                traceback.print_exc(file=o)
+                log(
+                    "WARNING: unable to produce a plot: "
+                    + (str(e) + "\n" + o.getvalue()).replace("\n", " ~~ "),
+                    severity=logging.WARNING,
+                )
+            with open(self.contentpath + "/images/missing.png", "rb") as _f:
+                return ("image/png", _f.read())
+
+        boundary = uuid.uuid4().hex
+        parts = []
+        for obj, (type, data) in zip(objs, self.plotpool.map(render, objs)):
+            parts.append(
+                (
+                    "--%s\r\nContent-Type: %s\r\nContent-Location: %s\r\n"
+                    "Content-Length: %d\r\n\r\n" % (boundary, type, obj, len(data))
+                ).encode("utf-8")
+            )
+            parts.append(data)
+            parts.append(b"\r\n")
+        parts.append(("--%s--\r\n" % boundary).encode("utf-8"))
+
+        self._noResponseCaching()
+        response.headers["Content-Type"] = 'multipart/mixed; boundary="%s"' % boundary
+        return b"".join(parts)
+
     # -----------------------------------------------------------------
     @expose
     @tools.params()
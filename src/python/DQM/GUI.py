@@ -3,8 +3,11 @@
 from stat import *
 from copy import deepcopy
 from html import escape
-from threading import Lock
+from threading import Lock, Event
+from collections import OrderedDict
+from fnmatch import fnmatchcase
 from Monitoring.DQM import Accelerator
+from Monitoring.DQM.visDQMUtils import pattern_to_filter, match_filters, load_listing
 from Monitoring.Core.Utils.Common import _logerr, _logwarn, _loginfo, ParameterManager
 from cherrypy import (
     expose,
@@ -19,7 +22,8 @@ from cherrypy import (
 )
 from cherrypy.lib.static import serve_file
 from cherrypy.lib import cptools, httputil
-import os, re, time, socket, shutil, tempfile, cgi, json, hmac, hashlib
+import os, re, time, socket, shutil, tempfile, cgi, json, hmac, hashlib, zlib, uuid
+import struct
 
 DEF_DQM_PORT = 9090
 
@@ -55,11 +59,12 @@ class DQMUpload:
         response.headers["dqm-status-message"] = message
         response.headers["dqm-status-detail"] = detail
 
-    # Set response headers to indicate an error, then get out.
-    def _error(self, code, message, detail=None):
+    # Set response headers to indicate an error, then get out with
+    # HTTP status HTTP.
+    def _error(self, code, message, detail=None, http=500):
         _logerr("code=%d, message=%s, detail=%s" % (code, message, detail))
         self._status(code, message, detail)
-        raise HTTPError(500, message)
+        raise HTTPError(http, message)
 
     # Check that a required parameter has been given just once,
     # and the value matches the given regular expression.
@@ -86,13 +91,20 @@ class DQMUpload:
 
     # Check the current request is into a directory, and if not,
     # redirect to add a trailing slash.
-    def _prepdir(self, time):
+    # Also sets the listing validators and answers conditional requests.
+    def _prepdir(self, time, etag=None, format="html"):
         pi = request.path_info
         if not pi.endswith("/"):
             raise HTTPRedirect(url(pi + "/", request.query_string))
         request.is_index = True
-        response.headers["Content-Type"] = "text/html"
+        if format == "json":
+            response.headers["Content-Type"] = "application/json"
+        else:
+            response.headers["Content-Type"] = "text/html"
         response.headers["Last-Modified"] = httputil.HTTPDate(time)
+        if etag:
+            response.headers["ETag"] = '"%s"' % etag
+            cptools.validate_etags()
         cptools.validate_since()
 
     def _check_authentication(self):
@@ -130,14 +142,20 @@ class DQMUpload:
 # --------------------------------------------------------------------
 # DQM extension to manage DQM file uploads.
 class DQMFileAccess(DQMUpload):
+    LISTINGS = 1000  # Maximum number of cached directory listings.
+
     def __init__(self, server, aclfile, uploads, roots):
-        self.lock = Lock()
+        self.locks = [Lock() for _ in range(64)]
+        self.listlock = Lock()
+        self.listings = OrderedDict()
         self.server = server
         self.uploads = uploads
+        self.chunked = uploads and uploads + "/chunked"
+        self.digests = {}
         self.roots = roots
         self.key = ""
-        if uploads and not os.path.exists(uploads):
-            os.makedirs(uploads)
+        if uploads and not os.path.exists(self.chunked):
+            os.makedirs(self.chunked)
         if aclfile and os.path.exists(aclfile):
             try:
                 with open(aclfile, "rb") as f:
@@ -152,20 +170,10 @@ class DQMFileAccess(DQMUpload):
         )
 
     # ------------------------------------------------------------------
-    # Store a file to the server.  Validates all the parameters, then
-    # attempts to save the file safely.  Sets headers in the response
-    # to indicate what happened, either an error or success.
-    # FIXME: Verify the request was submitted securely and is permitted.
-    # FIXME: Determine producer from certificate information.
-    @expose
-    @tools.params()
-    def put(self, size=None, checksum=None, file=None, *args, **kwargs):
+    # Verify the client is allowed to upload files.  Only relevant when
+    # the authentication happend via a Limited Proxy.
+    def _authorize(self):
         headers = request.headers
-        # Bail out if upload is not supported.
-        if not self.uploads:
-            raise HTTPError(404, "Not found")
-
-        # Authenticate user in case the authentication happend via a Limited Proxy.
         if "cms-auth-status" in headers:
             if not self._check_authentication():
                 self._log_authentication_failure_and_exit()
@@ -186,33 +194,19 @@ class DQMFileAccess(DQMUpload):
                     ].split(" "):
                         self._log_authentication_failure_and_exit()
 
-        # Argument validation.
-        if (
-            file == None
-            or not getattr(file, "file", None)
-            or not getattr(file, "filename", None)
-        ):
-            self._error(
-                self.STATUS_BAD_REQUEST,
-                "Incorrect or missing file argument",
-                "Must provide a single file-type argument",
-            )
-
+    # Validate the size, checksum and file name arguments of an upload.
+    def _checkUpload(self, size, checksum, filename):
         self._check("size", size, r"^\d+$")
         self._check("checksum", checksum, r"^(md5:[A-Za-z0-9]+|crc32:\d+)$")
-        self._check("filename", file.filename, r"^[-A-Za-z0-9_]+\.root$")
+        self._check("filename", filename, r"^[-A-Za-z0-9_]+\.root$")
 
-        m = re.match(
-            r"^(DQM)_V\d+(_[A-Za-z0-9]+)?_R(\d+)(__.*)?\.root", str(file.filename)
-        )
+        m = re.match(r"^(DQM)_V\d+(_[A-Za-z0-9]+)?_R(\d+)(__.*)?\.root", str(filename))
         if not m:
             self._error(
                 self.STATUS_ERROR_PARAMETER,
                 "File name does not match the expected convention",
             )
 
-        size = int(size)
-        runnr = int(m.group(3))
         if m.group(2) and m.group(4):
             self._error(
                 self.STATUS_ERROR_PARAMETER,
@@ -223,22 +217,45 @@ class DQMFileAccess(DQMUpload):
                 "workflow", m.group(4).replace("__", "/"), r"^(/[-A-Za-z0-9_]+){3}$"
             )
 
-        # Determine where we would save this file.  Update file version
-        # until we find a version that doesn't yet exist.  This permits
-        # multiple concurrent upload versions of the same file.  We need
-        # to lock around this so multiple concurrent uploads can't yield
-        # the same version number for two separate uploads.
+    # Check the uploaded data has the declared CHECKSUM, given its MD5
+    # and CRC32 computed while it was received.
+    def _verifyChecksum(self, checksum, md5, crc32):
+        if checksum.startswith("md5:"):
+            actual = "md5:" + md5.hexdigest()
+            ok = actual == checksum.lower()
+        else:
+            actual = "crc32:%d" % crc32
+            ok = actual == checksum
+        if not ok:
+            self._error(
+                self.STATUS_ERROR_PARAMETER,
+                "Checksum mismatch",
+                "Received data has checksum %s, expected %s" % (actual, checksum),
+            )
+
+    # Move the verified upload TMP of FILENAME into place and write its
+    # metadata descriptor file.  Determine where we would save this file:
+    # update file version until we find a version that doesn't yet exist.
+    # This permits multiple concurrent upload versions of the same file.
+    # We need to lock around this, and the move into place, so multiple
+    # concurrent uploads can't yield the same version number for two
+    # separate uploads; uploads of other files use other locks.  The md5
+    # recorded in the descriptor is marked verified so the receive daemon
+    # need not read the file again to check it.  Returns the final path.
+    def _storeUpload(self, tmp, filename, size, md5sum):
+        fname = None
+        saved = False
+        lock = self.locks[hash(str(filename)) % len(self.locks)]
+        lock.acquire()
         try:
-            self.lock.acquire()
             version = 1
             while True:
                 dir = "%s/%04d" % (self.uploads, version)
-                fname = "%s/%s" % (dir, file.filename)
+                fname = "%s/%s" % (dir, filename)
                 if not os.path.exists(fname) and not os.path.exists(fname + ".origin"):
                     break
                 version += 1
 
-            tmp = None
             if fname.find("..") >= 0 or fname.find("./") >= 0 or fname.find("/.") >= 0:
                 self._error(
                     self.STATUS_ERROR_PARAMETER,
@@ -246,25 +263,79 @@ class DQMFileAccess(DQMUpload):
                     "Path name cannot refer to '.' or '..'",
                 )
 
-            # Try saving the file safely.  First we write the file to a
-            # temporary directory, with a fake name, to the same directory as
-            # the final file would be.  We then move it in place atomically
-            # and write a metadata descriptor file.  If anything goes wrong,
-            # clean up so the upload can be re-attempted later.
             if not os.path.exists(dir):
                 os.makedirs(dir)
-            (fd, tmp) = tempfile.mkstemp(".upload", "", dir)
+            os.rename(tmp, fname)
+            saved = True
+            with open(fname + ".origin", "w") as _f:
+                _f.write("md5:%s %d %s verified\n" % (md5sum, size, fname))
+            return fname
+        except Exception:
+            if saved and os.path.exists(fname):
+                os.remove(fname)
+            if saved and os.path.exists(fname + ".origin"):
+                os.remove(fname + ".origin")
+            raise
+        finally:
+            lock.release()
+
+    # ------------------------------------------------------------------
+    # Store a file to the server.  Validates all the parameters, then
+    # attempts to save the file safely.  Sets headers in the response
+    # to indicate what happened, either an error or success.
+    # FIXME: Verify the request was submitted securely and is permitted.
+    # FIXME: Determine producer from certificate information.
+    @expose
+    @tools.params()
+    def put(self, size=None, checksum=None, file=None, *args, **kwargs):
+        # Bail out if upload is not supported.
+        if not self.uploads:
+            raise HTTPError(404, "Not found")
+
+        # Authenticate user in case the authentication happend via a Limited Proxy.
+        self._authorize()
+
+        # Argument validation.
+        if (
+            file == None
+            or not getattr(file, "file", None)
+            or not getattr(file, "filename", None)
+        ):
+            self._error(
+                self.STATUS_BAD_REQUEST,
+                "Incorrect or missing file argument",
+                "Must provide a single file-type argument",
+            )
+
+        self._checkUpload(size, checksum, file.filename)
+        size = int(size)
+
+        # Try saving the file safely.  First we stream the file into a
+        # private temporary file in the upload area, with a fake name the
+        # receive daemon ignores, without holding any lock, so concurrent
+        # uploads proceed in parallel.  The checksum is computed while the
+        # data is written and verified against the declared one.  Then
+        # move the file into place.  If anything goes wrong, clean up so
+        # the upload can be re-attempted later.
+        tmp = None
+        try:
+            (fd, tmp) = tempfile.mkstemp(".upload", "", self.uploads)
             nsaved = 0
             first = b""
-            while True:
-                data = file.file.read(8 * 1024 * 1024)
-                if len(data) < 1:
-                    break
-                if len(first) < 5:
-                    first += data[0:5]
-                os.write(fd, data)
-                nsaved += len(data)
-            os.close(fd)
+            md5 = hashlib.md5()
+            crc32 = 0
+            with os.fdopen(fd, "wb") as _f:
+                while True:
+                    data = file.file.read(8 * 1024 * 1024)
+                    if len(data) < 1:
+                        break
+                    if len(first) < 5:
+                        first += data[0:5]
+                    _f.write(data)
+                    md5.update(data)
+                    if checksum.startswith("crc32:"):
+                        crc32 = zlib.crc32(data, crc32)
+                    nsaved += len(data)
             os.chmod(tmp, 0o644)
             if first[0:5] != b"root\x00":
                 self._error(
@@ -278,17 +349,10 @@ class DQMFileAccess(DQMUpload):
                     "Failed to save file data",
                     "Wrote %d bytes, expected to write %d" % (nsaved, size),
                 )
-            shutil.move(tmp, fname)
-            with open(fname + ".origin", "w") as _f:
-                _f.write("%s %d %s\n" % (checksum, size, fname))
-            self.lock.release()
+            self._verifyChecksum(checksum, md5, crc32)
+            fname = self._storeUpload(tmp, file.filename, size, md5.hexdigest())
 
         except Exception as e:
-            self.lock.release()
-            if os.path.exists(fname):
-                os.remove(fname)
-            if os.path.exists(fname + ".origin"):
-                os.remove(fname + ".origin")
             if tmp and os.path.exists(tmp):
                 os.remove(tmp)
             if isinstance(e, HTTPError):
@@ -315,10 +379,299 @@ class DQMFileAccess(DQMUpload):
         )
         return message
 
+    # ------------------------------------------------------------------
+    # Resumable chunked uploads.  A client opens an upload with
+    #   /data/upload/open?filename=F&size=N
+    # which returns an upload id.  It then sends the file data in byte
+    # ranges, in any order and possibly in parallel, as request bodies of
+    #   /data/upload/chunk/ID?offset=K
+    # and can find out which ranges have been received with
+    #   /data/upload/status/ID
+    # which returns {"filename": F, "size": N, "received": [[start, end],
+    # ...]}.  Once all the data has arrived it completes the upload with
+    #   /data/upload/finish/ID?checksum=C
+    # which verifies the whole-file checksum and moves the data into the
+    # upload area like put(), without copying it.  The data is written
+    # directly into a file of the final size in .chunked, next to a json
+    # state file.  Uploads not touched for two days are removed.  Chunks
+    # must be sent with a Content-Length.  The checksums of the leading
+    # chunks received in order are computed as they arrive and kept in
+    # .digests, so finish only reads the data received out of order.
+    @expose
+    @tools.params()
+    def upload(self, action=None, id=None, *args, **kwargs):
+        if not self.uploads:
+            raise HTTPError(404, "Not found")
+        self._authorize()
+
+        if action == "open" and id is None:
+            return self._uploadOpen(**kwargs)
+
+        if id is None or not re.match(r"^[0-9a-f]{32}$", id):
+            self._error(self.STATUS_BAD_REQUEST, "Incorrect or missing upload id")
+        path = "%s/%s" % (self.chunked, id)
+
+        # The upload may complete or expire at any time, removing its
+        # files under a request for it.
+        try:
+            if action == "chunk":
+                return self._uploadChunk(path, **kwargs)
+            elif action == "status":
+                response.headers["Content-Type"] = "application/json"
+                return json.dumps(self._uploadState(path, None))
+            elif action == "finish":
+                return self._uploadFinish(path, **kwargs)
+        except FileNotFoundError:
+            self._error(self.STATUS_ERROR_NOT_EXISTS, "No such upload", id, 404)
+        self._error(self.STATUS_BAD_REQUEST, "Unknown upload action")
+
+    upload._cp_config["request.process_request_body"] = False
+
+    def _uploadOpen(self, filename=None, size=None, **kwargs):
+        self._checkUpload(size, "md5:0", filename)
+        size = int(size)
+
+        old = time.time() - 2 * 86400
+        for f in os.listdir(self.chunked):
+            stale = "%s/%s" % (self.chunked, f[:-5])
+            try:
+                if f.endswith(".json") and os.stat(stale + ".json")[ST_MTIME] < old:
+                    for ext in (".json", ".upload"):
+                        if os.path.exists(stale + ext):
+                            os.remove(stale + ext)
+                    self.digests.pop(stale, None)
+            except OSError:
+                pass
+
+        id = uuid.uuid4().hex
+        path = "%s/%s" % (self.chunked, id)
+        with open(path + ".upload", "wb") as _f:
+            _f.truncate(size)
+        self._uploadState(path, {"filename": filename, "size": size, "received": []})
+        self._status(self.STATUS_OK, "Upload opened", id)
+        _loginfo("opened chunked upload %s for %s size %d" % (id, filename, size))
+        response.headers["Content-Type"] = "text/plain"
+        return id
+
+    # Read the state of upload PATH, or update it if STATE is given, or
+    # if RANGE is given, add the byte range [start, end) to the received
+    # ranges.  Returns the resulting state.
+    def _uploadState(self, path, state, range=None):
+        save = state is not None or range is not None
+        lock = self.locks[hash(path) % len(self.locks)]
+        lock.acquire()
+        try:
+            if state is None:
+                with open(path + ".json") as _f:
+                    state = json.load(_f)
+            if range:
+                ranges = sorted(state["received"] + [list(range)])
+                state["received"] = [ranges[0]]
+                for (start, end) in ranges[1:]:
+                    if start <= state["received"][-1][1]:
+                        state["received"][-1][1] = max(state["received"][-1][1], end)
+                    else:
+                        state["received"].append([start, end])
+            if save:
+                with open(path + ".json.tmp", "w") as _f:
+                    json.dump(state, _f)
+                os.rename(path + ".json.tmp", path + ".json")
+            return state
+        finally:
+            lock.release()
+
+    # Claim the running checksum of upload PATH for a chunk at offset
+    # START, or at any offset if START is None.  Returns [offset, md5,
+    # crc32, busy] if the chunk continues the data checksummed so far and
+    # no other chunk is being added to it, None otherwise.  The caller
+    # must release it with _uploadSum().  A chunk rewriting data already
+    # summed discards the checksum; finish then reads the whole file.
+    def _uploadDigest(self, path, start=None):
+        lock = self.locks[hash(path) % len(self.locks)]
+        lock.acquire()
+        try:
+            digest = self.digests.get(path, None)
+            if digest and start is not None and start < digest[0]:
+                # Data already summed is being rewritten, start over.
+                del self.digests[path]
+                digest = None
+            if digest is None and start == 0:
+                digest = self.digests[path] = [0, hashlib.md5(), 0, False]
+            if digest is None or digest[3] or start not in (None, digest[0]):
+                return None
+            digest[3] = True
+            return digest
+        finally:
+            lock.release()
+
+    # Release DIGEST of upload PATH after NBYTES more bytes were added.
+    def _uploadSum(self, path, digest, nbytes):
+        lock = self.locks[hash(path) % len(self.locks)]
+        lock.acquire()
+        try:
+            digest[0] += nbytes
+            digest[3] = False
+        finally:
+            lock.release()
+
+    def _uploadChunk(self, path, offset=None, **kwargs):
+        self._check("offset", offset, r"^\d+$")
+        length = request.headers.get("Content-Length", None)
+        if length is None or "Transfer-Encoding" in request.headers:
+            self._error(
+                self.STATUS_BAD_REQUEST,
+                "Chunk length required",
+                "Chunks must be sent with a Content-Length header",
+                411,
+            )
+        if not re.match(r"^\d+$", length):
+            self._error(self.STATUS_BAD_REQUEST, "Invalid Content-Length", length, 400)
+
+        state = self._uploadState(path, None)
+        start = int(offset)
+        length = int(length)
+        if start + length > state["size"]:
+            self._error(
+                self.STATUS_ERROR_PARAMETER,
+                "Chunk beyond end of file",
+                "Chunk ends at %d, file size is %d" % (start + length, state["size"]),
+            )
+
+        nsaved = 0
+        fd = os.open(path + ".upload", os.O_WRONLY)
+        digest = self._uploadDigest(path, start)
+        try:
+            while nsaved < length:
+                data = request.rfile.read(min(8 * 1024 * 1024, length - nsaved))
+                if len(data) < 1:
+                    break
+                os.pwrite(fd, data, start + nsaved)
+                nsaved += len(data)
+                if digest:
+                    digest[1].update(data)
+                    digest[2] = zlib.crc32(data, digest[2])
+        finally:
+            os.close(fd)
+            if digest:
+                self._uploadSum(path, digest, nsaved)
+
+        if nsaved:
+            self._uploadState(path, None, (start, start + nsaved))
+        if nsaved != length:
+            self._error(
+                self.STATUS_FAIL_EXECUTE,
+                "Failed to save chunk data",
+                "Wrote %d bytes, expected to write %d" % (nsaved, length),
+            )
+        self._status(self.STATUS_OK, "Chunk saved", "Wrote %d bytes" % nsaved)
+        return "Thanks.\n"
+
+    def _uploadFinish(self, path, checksum=None, **kwargs):
+        self._check("checksum", checksum, r"^(md5:[A-Za-z0-9]+|crc32:\d+)$")
+        state = self._uploadState(path, None)
+        size = state["size"]
+        if state["received"] != [[0, size]] and size > 0:
+            self._error(
+                self.STATUS_ERROR_PARAMETER,
+                "Upload incomplete",
+                "Received byte ranges %s of %d" % (state["received"], size),
+            )
+
+        # Complete the checksum of the assembled file.  The leading chunks
+        # received in order have already been summed; read the rest.
+        digest = self._uploadDigest(path)
+        if digest:
+            (start, md5, crc32) = (digest[0], digest[1].copy(), digest[2])
+            self._uploadSum(path, digest, 0)
+        else:
+            (start, md5, crc32) = (0, hashlib.md5(), 0)
+        with open(path + ".upload", "rb") as _f:
+            first = _f.read(5)
+            _f.seek(start)
+            for data in iter(lambda: _f.read(8 * 1024 * 1024), b""):
+                md5.update(data)
+                crc32 = zlib.crc32(data, crc32)
+        if first != b"root\x00":
+            self._error(
+                self.STATUS_ERROR_PARAMETER,
+                "Not a ROOT file",
+                "File data contents do not represent a ROOT file",
+            )
+        self._verifyChecksum(checksum, md5, crc32)
+
+        os.chmod(path + ".upload", 0o644)
+        try:
+            fname = self._storeUpload(
+                path + ".upload", state["filename"], size, md5.hexdigest()
+            )
+        except Exception as e:
+            if isinstance(e, HTTPError):
+                raise e
+            self._error(
+                self.STATUS_FAIL_EXECUTE,
+                "Failed to save file data",
+                str(e).replace("\n", "; "),
+            )
+        os.remove(path + ".json")
+        self.digests.pop(path, None)
+
+        self._status(self.STATUS_OK, "File saved", "Wrote %d bytes" % size)
+        _loginfo("saved file %s size %d checksum %s" % (fname, size, checksum))
+        return "Thanks.\n"
+
+    # ------------------------------------------------------------------
+    # Return the contents of directory PATHNAME with stat info ST as a
+    # list of (name, isdir, size, mtime) tuples in reverse name order.
+    # Listings are cached per directory and rebuilt only when the
+    # directory inode or modification time changes, so unchanged
+    # directories are neither re-read nor their entries stat()ed again
+    # on every request.  Files are moved into the served areas by
+    # renames, which update the directory time stamp.  The trade-off is
+    # that a file modified in place without a rename keeps its cached
+    # size and time until something else changes the directory.
+    # Listings of directories modified in the last few seconds are not
+    # cached in case the directory changes again within the time stamp
+    # resolution.
+    def _listing(self, pathname, st):
+        key = (st.st_ino, st.st_mtime_ns)
+        with self.listlock:
+            item = self.listings.get(pathname)
+            if item and item[0] == key:
+                self.listings.move_to_end(pathname)
+                return item[1]
+
+        files = []
+        for x in os.listdir(pathname):
+            if not re.match(RX_SAFE_PATH, x):
+                continue
+            try:
+                xst = os.stat(pathname + "/" + x, follow_symlinks=False)
+            except OSError:
+                continue
+            if S_ISLNK(xst.st_mode):
+                continue
+            files.append((x, S_ISDIR(xst.st_mode), xst.st_size, xst.st_mtime))
+        files.sort(reverse=True)
+
+        if time.time() - st.st_mtime > 2:
+            with self.listlock:
+                self.listings[pathname] = (key, files)
+                self.listings.move_to_end(pathname)
+                while len(self.listings) > self.LISTINGS:
+                    self.listings.popitem(last=False)
+        return files
+
     # ------------------------------------------------------------------
     # Retrieve files from the server.  Pretends to be somewhat like the
     # apache mod_dir file browsing scheme.  Serves only files with valid
-    # and safe path references.  FIXME: Bandwidth limiting and ACLs?
+    # and safe path references.  Directory listings are HTML, or with
+    # "?format=json" a JSON object {"path": P, "items": [{"name": N,
+    # "type": "dir" or "file", "size": S, "mtime": T}, ...]} for tools;
+    # the size and mtime are null for the top level roots and the size
+    # is null for directories.  Listings carry an ETag and Last-Modified
+    # derived from the directory inode and time stamp, like the listing
+    # cache, so clients can skip the directories which have not changed.
+    # FIXME: Bandwidth limiting and ACLs?
     @expose
     @tools.params()
     def browse(self, *path, **kwargs):
@@ -330,9 +683,24 @@ class DQMFileAccess(DQMUpload):
             if not re.match(RX_SAFE_PATH, x):
                 raise HTTPError(404, "Not found")
 
+        format = kwargs.get("format", "html")
+        if format not in ("html", "json"):
+            raise HTTPError(400, "Unsupported listing format")
+
         # If no path was given, provide list of top level roots.
         if len(path) == 0:
-            self._prepdir(self.server.stamp)
+            stamp = self.server.stamp
+            self._prepdir(stamp, "%s-%x" % (format, int(stamp)), format)
+            if format == "json":
+                return json.dumps(
+                    {
+                        "path": "",
+                        "items": [
+                            {"name": x, "type": "dir", "size": None, "mtime": None}
+                            for x in sorted(self.roots.keys())
+                        ],
+                    }
+                )
             return (
                 "<html><head><title>Index of %(index)s</title></head><body>"
                 "<h1>%(index)s</h1><table border='0' valign='top' cellpadding='3'>"
@@ -366,17 +734,25 @@ class DQMFileAccess(DQMUpload):
                     raise HTTPError(404, "Not found")
             except OSError:
                 raise HTTPError(404, "Not found")
-            self._prepdir(st.st_mtime)
-            files = [
-                (x, pathname + "/" + x)
-                for x in os.listdir(pathname)
-                if re.match(RX_SAFE_PATH, x)
-            ]
-            files = [
-                (x[0], x[1], os.path.isdir(x[1]), os.stat(x[1]))
-                for x in files
-                if not os.path.islink(x[1])
-            ]
+            self._prepdir(
+                st.st_mtime, "%s-%x-%x" % (format, st.st_ino, st.st_mtime_ns), format
+            )
+            files = self._listing(pathname, st)
+            if format == "json":
+                return json.dumps(
+                    {
+                        "path": "/".join(path),
+                        "items": [
+                            {
+                                "name": x[0],
+                                "type": (x[1] and "dir") or "file",
+                                "size": None if x[1] else x[2],
+                                "mtime": int(x[3]),
+                            }
+                            for x in files
+                        ],
+                    }
+                )
             return (
                 "<html><head><title>Index of %(index)s</title></head><body>"
                 "<h1>%(index)s</h1><p style='padding-left:5px'>"
@@ -396,13 +772,13 @@ class DQMFileAccess(DQMUpload):
                                 "root": rooturl,
                                 "path": escape("/".join(path)),
                                 "name": escape(x[0]),
-                                "slash": (x[2] and "/") or "",
-                                "size": (x[2] and "-") or x[3].st_size,
+                                "slash": (x[1] and "/") or "",
+                                "size": (x[1] and "-") or x[2],
                                 "mtime": time.strftime(
-                                    "%Y-%m-%d %H:%M:%S", time.gmtime(x[3].st_mtime)
+                                    "%Y-%m-%d %H:%M:%S", time.gmtime(x[3])
                                 ),
                             }
-                            for x in sorted(files)[::-1]
+                            for x in files
                         ]
                     ),
                 }
@@ -529,27 +905,27 @@ class DQMToJSON(Accelerator.DQMToJSON):
     @tools.params()
     @tools.gzip()
     def samples(self, *args, **options):
-        sources = dict(
-            (s.plothook, s) for s in self.server.sources if getattr(s, "plothook", None)
-        )
+        sources = self.server.plothooks
         (stamp, result) = self._samples(sources.values(), options)
         response.headers["Content-Type"] = "text/plain"
         response.headers["Last-Modified"] = httputil.HTTPDate(stamp)
         return result
 
-    @expose
-    @tools.params()
-    def default(self, srcname, runnr, dsP, dsW, dsT, *path, **options):
-        sources = dict(
-            (s.plothook, s) for s in self.server.sources if getattr(s, "plothook", None)
-        )
+    # Return the layout source registered to the server, if any.
+    def _layoutSource(self):
         layoutSrc = None
         for s in self.server.sources:
             if isinstance(s, DQMLayoutSource):
                 layoutSrc = s
+        return layoutSrc
+
+    @expose
+    @tools.params()
+    def default(self, srcname, runnr, dsP, dsW, dsT, *path, **options):
+        sources = self.server.plothooks
         if srcname in sources:
             (stamp, result) = self._list(
-                layoutSrc,
+                self._layoutSource(),
                 sources[srcname],
                 int(runnr),
                 "/".join(("", dsP, dsW, dsT)),
@@ -564,6 +940,130 @@ class DQMToJSON(Accelerator.DQMToJSON):
             response.headers["Last-Modified"] = httputil.HTTPDate(self.server.stamp)
             return "{}"
 
+    # Return the json of many objects of one sample in a single response.
+    # The objects are given as repeated "obj" full path arguments, and/or
+    # as a "dir" directory and a "glob" pattern matched against the names
+    # of the objects directly in that directory.  Remaining options are
+    # passed on to the source's getJson() for every object.  The result,
+    # {"results": [{"path": ..., "json": ...}, ...]}, is streamed out one
+    # object at a time; objects which fail have an "error" instead.
+    @expose
+    @tools.params()
+    @tools.gzip()
+    def batch(self, srcname, runnr, dsP, dsW, dsT, **options):
+        source = self.server.jsonhooks.get(srcname, None)
+        if not source or not getattr(source, "getJson", None):
+            raise HTTPError(500, "No json source %s" % srcname)
+
+        paths = options.pop("obj", [])
+        if isinstance(paths, str):
+            paths = [paths]
+        dir = options.pop("dir", None)
+        glob = options.pop("glob", None)
+        if glob is not None and srcname in self.server.plothooks:
+            (stamp, result) = self._list(
+                self._layoutSource(),
+                self.server.plothooks[srcname],
+                int(runnr),
+                "/".join(("", dsP, dsW, dsT)),
+                (dir or "").strip("/"),
+                {},
+            )
+            paths += [
+                c["path"]
+                for c in load_listing(result)["contents"]
+                if "obj" in c and fnmatchcase(c["obj"], glob)
+            ]
+
+        def stream():
+            yield '{"results": ['
+            sep = "\n"
+            for path in paths:
+                try:
+                    data = source.getJson(
+                        runnr, dsP, dsW, dsT, *path.split("/"), **options
+                    )
+                    yield '%s{"path": %s, "json": %s}' % (
+                        sep,
+                        json.dumps(path),
+                        data or "null",
+                    )
+                except Exception as e:
+                    yield '%s{"path": %s, "error": %s}' % (
+                        sep,
+                        json.dumps(path),
+                        json.dumps(str(e)),
+                    )
+                sep = ",\n"
+            yield "\n]}\n"
+
+        response.headers["Content-Type"] = "application/json"
+        return stream()
+
+    batch._cp_config["response.stream"] = True
+
+    # Search the contents of one sample for objects matching the path
+    # "glob", with the pattern semantics of dqm-grep -f, for example
+    # "/**/EventInfo/*Summary".  The directory tree is walked here one
+    # _list() call per directory the pattern can match into, instead of
+    # one HTTP request per directory from the client.  The matches are
+    # streamed out as {"results": [{"path": ..., "item": ...}, ...]}
+    # where "item" is the object's or subdirectory's listing entry.  The
+    # remaining options are passed to _list().  Should listing fail part
+    # way through, the results so far are closed off and followed by an
+    # "error" member, so the response is still valid json.
+    @expose
+    @tools.params()
+    @tools.gzip()
+    def search(self, srcname, runnr, dsP, dsW, dsT, **options):
+        source = self.server.plothooks.get(srcname, None)
+        if not source:
+            raise HTTPError(500, "No source %s" % srcname)
+        try:
+            filters = pattern_to_filter(options.pop("glob", ""))
+        except (ValueError, re.error) as e:
+            raise HTTPError(400, "Bad glob pattern: %s" % str(e))
+
+        layoutSrc = self._layoutSource()
+        dataset = "/".join(("", dsP, dsW, dsT))
+        runnr = int(runnr)
+
+        def stream():
+            yield '{"results": ['
+            sep = "\n"
+            pending = [("/", [0])]
+            try:
+                while pending:
+                    (path, poslist) = pending.pop(0)
+                    (stamp, result) = self._list(
+                        layoutSrc, source, runnr, dataset, path.strip("/"), options
+                    )
+                    seen = set()
+                    for item in load_listing(result)["contents"]:
+                        name, matched, descend, newpos = match_filters(
+                            item, filters, poslist
+                        )
+                        if matched:
+                            yield '%s{"path": %s, "item": %s}' % (
+                                sep,
+                                json.dumps(path + name),
+                                json.dumps(item),
+                            )
+                            sep = ",\n"
+                        if descend and name not in seen and newpos:
+                            pending.append((path + name + "/", newpos))
+                        seen.add(name)
+            except Exception as e:
+                _logwarn("search of %s%s failed: %s" % (runnr, dataset, str(e)))
+                yield '\n], "error": %s}\n' % json.dumps(str(e))
+                return
+            yield "\n]}\n"
+
+        response.headers["Content-Type"] = "application/json"
+        return stream()
+
+    search._cp_config["response.stream"] = True
+
 
 # --------------------------------------------------------------------
 # Management interface for talking to the ROOT rendering process.
@@ -606,9 +1106,7 @@ class DQMOverlaySource(Accelerator.DQMOverlaySource):
     # and generates final list of (source, runnr, dataset, path, label)
     # tuples to pass to C++ layer to process.
     def plot(self, *junk, **options):
-        sources = dict(
-            (s.plothook, s) for s in self.server.sources if getattr(s, "plothook", None)
-        )
+        sources = self.server.plothooks
 
         objs = options.get("obj", [])
         labels = options.get("reflabel", [])
@@ -663,9 +1161,7 @@ class DQMStripChartSource(Accelerator.DQMStripChartSource):
         if "trend" not in options:
             raise HTTPError(500, "Missing trend argument")
 
-        sources = dict(
-            (s.plothook, s) for s in self.server.sources if getattr(s, "plothook", None)
-        )
+        sources = self.server.plothooks
         info = None
         current = options.get("current", None)
         if current != None:
@@ -691,9 +1187,7 @@ class DQMCertificationSource(Accelerator.DQMCertificationSource):
     # C++ layer to process.
 
     def plot(self, *path, **options):
-        sources = dict(
-            (s.plothook, s) for s in self.server.sources if getattr(s, "plothook", None)
-        )
+        sources = self.server.plothooks
         info = None
         current = options.get("current", None)
         if current != None:
@@ -762,7 +1256,11 @@ class DQMLayoutSource(Accelerator.DQMLayoutSource):
 #   dqmhost     - DQMCollector host name, taken from --collector option.
 #   dqmport     - DQMCollector port, taken from --collector option.
 #   plotport    - Port at which visDQMRender is listening, taken from --listen option.
+# .images       DQMImageCache of rendered images by object version.
 class DQMLiveSource(Accelerator.DQMLiveSource):
+    imagecachesize = 50 * 1024 * 1024
+    imagelifetime = 60
+
     # Start off the live backend and hook up to server transitions.
     def __init__(self, server, statedir, collector, *params):
         self.opts = {
@@ -780,11 +1278,133 @@ class DQMLiveSource(Accelerator.DQMLiveSource):
 
         Accelerator.DQMLiveSource.__init__(self, server, self.opts)
         engine.subscribe("exit", lambda *args: self._exit(), priority=100)
+        self.images = DQMImageCache(self.imagecachesize, self.imagelifetime)
 
-    # Generate an object image given an object path and options.
+    # Generate an object image given an object path and options.  The
+    # same version of an object is often shown by many sessions at once,
+    # so images of objects held locally are kept for a short while and
+    # concurrent identical requests share a single render.
     def plot(self, runnr, dsP, dsW, dsT, *path, **options):
-        a = self._plot("/".join(path), options)
-        return (a[0], bytes(a[1]))
+        name = "/".join(path)
+
+        def render():
+            a = self._plot(name, options)
+            return (a[0], bytes(a[1]))
+
+        version = self._version(name)
+        if not version:
+            return render()
+        key = repr((name, version, DQMImageCache.renderOptions(options)))
+        return self.images.get(None, key, render)
+
+
+# --------------------------------------------------------------------
+# Cache of rendered images of immutable objects, shared by all users.
+# Images are kept in least recently used order and evicted once their
+# total size exceeds .sizelimit bytes, or once they are older than
+# .lifetime seconds if set.  Concurrent requests for the same image wait
+# for a single render instead of rendering it again, and the whole cache
+# is dropped when the index generation changes.  A request waits at most
+# .waittime seconds for another one's render, and renders the image
+# itself if that takes longer or does not finish.
+#
+# .lock         Lock protecting the other attributes.
+# .sizelimit    Maximum total size of the cached images in bytes.
+# .lifetime     Maximum age of the cached images in seconds, or None.
+# .waittime     Maximum time to wait for another request's render.
+# .size         Current total size of the cached images in bytes.
+# .images       Cached (expiry, (type, data)) in LRU order, by key.
+# .inflight     [event, result, error, done] of renders in progress, by
+#               key; done is set once the render returned or raised.
+# .generation   The index generation the cached images belong to.
+#
+# .IGNORED      Request options which do not affect the image: the
+#               client session, and the version and stamp parameters
+#               which only defeat browser caching.
+class DQMImageCache:
+    IGNORED = ("session", "stamp", "v")
+
+    def __init__(self, sizelimit, lifetime=None, waittime=30):
+        self.lock = Lock()
+        self.sizelimit = sizelimit
+        self.lifetime = lifetime
+        self.waittime = waittime
+        self.size = 0
+        self.images = OrderedDict()
+        self.inflight = {}
+        self.generation = None
+
+    # Return the image for KEY in index GENERATION, calling RENDER to
+    # produce it if it is not cached or being rendered already.
+    def get(self, generation, key, render):
+        self.lock.acquire()
+        try:
+            if generation != self.generation:
+                self.images.clear()
+                self.size = 0
+                self.generation = generation
+            if key in self.images:
+                (expiry, result) = self.images[key]
+                if expiry is None or expiry > time.time():
+                    self.images.move_to_end(key)
+                    return result
+                del self.images[key]
+                self.size -= len(result[1])
+            waiter = self.inflight.get(key, None)
+            owner = waiter is None
+            if owner:
+                waiter = self.inflight[key] = [Event(), None, None, False]
+        finally:
+            self.lock.release()
+
+        if not owner:
+            if not waiter[0].wait(self.waittime) or not waiter[3]:
+                return render()
+            if waiter[2] is not None:
+                raise waiter[2]
+            return waiter[1]
+
+        try:
+            waiter[1] = render()
+            waiter[3] = True
+        except Exception as e:
+            waiter[2] = e
+            waiter[3] = True
+            raise
+        finally:
+            self.lock.acquire()
+            try:
+                del self.inflight[key]
+                if waiter[2] is None and waiter[3] and self.generation == generation:
+                    self._insert(key, waiter[1])
+            finally:
+                self.lock.release()
+                waiter[0].set()
+        return waiter[1]
+
+    # Return the render options in OPTIONS as a sorted list of (name,
+    # value) pairs suitable for a cache key, leaving out the IGNORED
+    # request bookkeeping so all sessions share the same images.
+    @classmethod
+    def renderOptions(cls, options):
+        return sorted((k, v) for (k, v) in options.items() if k not in cls.IGNORED)
+
+    # Add RESULT to the cache, evicting old images.  Failed renders are
+    # not cached.  Must be called with the lock held.
+    def _insert(self, key, result):
+        if result is None or result[0] is None or result[1] is None:
+            return
+        size = len(result[1])
+        if size > self.sizelimit:
+            return
+        if key in self.images:
+            self.size -= len(self.images.pop(key)[1][1])
+        expiry = self.lifetime and time.time() + self.lifetime
+        self.images[key] = (expiry, result)
+        self.size += size
+        while self.size > self.sizelimit:
+            (k, old) = self.images.popitem(last=False)
+            self.size -= len(old[1][1])
 
 
 # --------------------------------------------------------------------
@@ -798,20 +1418,73 @@ class DQMLiveSource(Accelerator.DQMLiveSource):
 #   plotport    - Port at which visDQMRender is listening.
 #   rxonline    - Regexp to recognise online dataset name.
 #   index       - Path to the index directory.
+# .images       DQMImageCache of rendered images, .imagecachesize bytes.
 class DQMArchiveSource(Accelerator.DQMArchiveSource):
+    imagecachesize = 200 * 1024 * 1024
+
     def __init__(self, server, statedir, indexdir, rxonline, *params):
         self.opts = {"index": indexdir, "rxonline": rxonline}
         Accelerator.DQMArchiveSource.__init__(self, server, self.opts)
         engine.subscribe("exit", lambda *args: self._exit(), priority=100)
+        self._generation = (0, None)
+        self.images = DQMImageCache(self.imagecachesize)
+
+    # Return the index generation as a (tag, mtime) tuple.  The tag
+    # combines the generation counter stored in the generation file with
+    # the file's modification time in nanoseconds, so two updates within
+    # the same second still give different tags.  The file is checked at
+    # most every few seconds.  Returns None for a generation too recent
+    # to be sure the C++ layer has already switched to it: it polls for
+    # changes every 30 seconds.
+    def _indexGeneration(self):
+        now = time.time()
+        (checked, generation) = self._generation
+        if now - checked > 5:
+            try:
+                with open(self.opts["index"] + "/generation", "rb") as f:
+                    st = os.fstat(f.fileno())
+                    (counter,) = struct.unpack("=I", f.read(4))
+                generation = ("%d-%x" % (counter, st.st_mtime_ns), st.st_mtime)
+            except (OSError, struct.error):
+                generation = None
+            self._generation = (now, generation)
+        if generation is None or now - generation[1] < 60:
+            return None
+        return generation
+
+    # Return cache validators for the plot or json of an archived object:
+    # an etag made of the index generation, the object and the render
+    # options, and the time of the generation.  See Server.plotfairy.
+    def validator(self, runnr, dsP, dsW, dsT, *path, **options):
+        generation = self._indexGeneration()
+        if generation is None:
+            return None
+        key = self._objectKey(generation[0], runnr, dsP, dsW, dsT, path, options)
+        return (hashlib.sha1(key.encode("utf-8")).hexdigest(), int(generation[1]))
+
+    # Return a key identifying the object image or json in index
+    # generation TAG, independent of the session asking for it.
+    def _objectKey(self, tag, runnr, dsP, dsW, dsT, path, options):
+        options = DQMImageCache.renderOptions(options)
+        return repr((tag, runnr, dsP, dsW, dsT, path, options))
 
     # Generate an object image given an object type ('scalar' or
     # 'rootobj'), the run number, dataset path, object name and render
     # options.  See ROOTImage for details about image generation.
+    # Images of a settled index generation are immutable, so they are
+    # served from the image cache, rendering only the new ones.
     def plot(self, runnr, dsP, dsW, dsT, *path, **options):
-        a = self._plot(
-            int(runnr), "/".join(("", dsP, dsW, dsT)), "/".join(path), options
-        )
-        return (a[0], bytes(a[1]))
+        def render():
+            a = self._plot(
+                int(runnr), "/".join(("", dsP, dsW, dsT)), "/".join(path), options
+            )
+            return (a[0], bytes(a[1]))
+
+        generation = self._indexGeneration()
+        if generation is None:
+            return render()
+        key = self._objectKey(generation[0], runnr, dsP, dsW, dsT, path, options)
+        return self.images.get(generation[0], key, render)
 
     # Generate a json describtion given an object type ('scalar' or
     # 'rootobj'), the run number, dataset path, object name and render
@@ -1,4 +1,7 @@
+import os
 import re
+import json
+import sqlite3
 
 # Various regular expressions used to check filename validity:
 
@@ -140,3 +143,267 @@ def classifyDQMFile(path):
         return False, "file matches no known naming convention"
     except:
         return False, "error while classifying file name"
+
+
+# --------------------------------------------------------------------
+# Path glob search over DQM sample contents, with the same semantics as
+# the -f filters of dqm-grep and dqm-access.
+
+# Object types.
+DIR = 0  # Directory
+FILE = 1  # File / simple object.
+ANY = 2  # Either; used only for filters.
+
+
+# One step of a search filter.
+#   type:    the type of object the filter can match: FILE, DIR or ANY.
+#   recurse: apply the pattern recursively to subdirectories if True.
+#   pattern: the regular expression pattern as a string.
+#   rx:      the regular expression as a compiled regexp object.
+class SearchFilter:
+    type = FILE
+    recurse = False
+    pattern = ""
+    rx = None
+
+    def __repr__(self):
+        return "(filter pattern='%s' type=%s recurse=%s)" % (
+            self.pattern,
+            self.type,
+            self.recurse,
+        )
+
+
+# Convert a search pattern such as "/*/EventInfo/**/*Summary" into a
+# list of SearchFilter steps.  A single star matches within a single
+# directory, a double star matches directories recursively and a triple
+# star matches either directories or objects recursively.  A name with
+# a trailing slash matches directories, one without non-directories.
+# The pattern must start with a slash.  Raises ValueError for invalid
+# patterns.
+def pattern_to_filter(pattern):
+    filters = []
+
+    # Check the pattern starts with '/'
+    if not pattern.startswith("/"):
+        raise ValueError("pattern must start with slash")
+
+    # Process pattern as directory search specs, but collapse
+    # repeated slashes into one slash first.
+    for part in re.sub("/+", "/", pattern).split("/")[1:]:
+        if filters and filters[-1].type == FILE:
+            filters[-1].type = DIR
+        f = SearchFilter()
+        filters.append(f)
+        for term in re.split("([*]+)", part):
+            if term == "***":
+                f.pattern += ".*"
+                f.recurse = True
+                f.type = ANY
+            elif term == "**":
+                f.pattern += ".*"
+                f.recurse = True
+                f.type = DIR
+            elif term == "*":
+                f.pattern += "[^/]*"
+                f.type = FILE
+            elif term:
+                f.pattern += re.escape(term)
+                f.type = FILE
+        if f.pattern != ".*":
+            f.pattern = "^%s$" % f.pattern
+        f.rx = re.compile(f.pattern)
+
+    # A trailing slash leaves an empty name, which would never match;
+    # drop it so the pattern matches the directory itself.
+    last = filters[-1]
+    if last.type == FILE and not last.recurse and last.pattern == "^$":
+        filters.pop()
+    if not filters:
+        raise ValueError("pattern matches nothing")
+
+    return filters
+
+
+# Match the FILTERS from pattern_to_filter() at positions POSLIST against
+# ITEM, a "subdir" or "obj" entry of a DQM json directory listing.  The
+# positions form the NFA search stack, starting with [0].  Returns a tuple
+# of the matched name, whether the entire filter chain matched, whether
+# the filters require descending into the item as a subdirectory, and the
+# new position list for searching the subdirectory.
+def match_filters(item, filters, poslist):
+    newposlist = []
+    descend = False
+    matched = False
+    name = None
+
+    for idx in poslist:
+        f = filters[idx]
+        fmatched = False
+        if (
+            "subdir" in item
+            and (f.type == DIR or f.type == ANY)
+            and f.rx.match(item["subdir"])
+        ):
+            descend = fmatched = True
+            name = item["subdir"]
+        elif (
+            "obj" in item
+            and (f.type == FILE or f.type == ANY)
+            and f.rx.match(item["obj"])
+        ):
+            fmatched = True
+            name = item["obj"]
+
+        if fmatched:
+            if idx == len(filters) - 1:
+                matched = True
+            if f.recurse:
+                newposlist.append(idx)
+            if idx < len(filters) - 1:
+                newposlist.append(idx + 1)
+
+    return name, matched, descend, newposlist
+
+
+# Parse TEXT, a DQM json directory listing, into python objects.  The
+# listing is not strictly valid json: scalar string values are quoted
+# twice, as in "value": ""x"", and statistics of empty or overflowing
+# histograms are written as a bare nan or inf.  These are fixed up into
+# the strings "NaN", "Inf" and "-Inf" before parsing.
+def load_listing(text):
+    text = re.sub(r'("value": ")"([A-Za-z0-9_]+")"', r"\1\2", text)
+    text = re.sub(r'("(?:mean|rms|min|max|nentries)":) nan(?=[,}])', r'\1 "NaN"', text)
+    text = re.sub(
+        r'("(?:mean|rms|min|max|nentries)":) (-?)inf(?=[,}])', r'\1 "\2Inf"', text
+    )
+    return json.loads(text)
+
+
+# --------------------------------------------------------------------
+# Regexp for the version part of a repository file path.
+RXVERSION = re.compile(r"DQM_V(\d{4})_")
+
+
+# Return the version-free file pattern of a repository file path, the
+# same as the "filepat" the receive daemon assigns, e.g.
+# "OnlineData/00012xxxx/0001234xx/DQM_V%04d_R000123456.root".  All the
+# versions of one (class, dataset, run) file share the same pattern.
+def version_pattern(path):
+    return RXVERSION.sub("DQM_V%04d_", path, count=1)
+
+
+# Persistent index of the file versions in a DQM file repository.  The
+# index records every version registered in the repository, keyed by
+# the version_pattern() of the file, so the agents can assign the next
+# version and check whether a file is the newest one without globbing
+# or probing the repository directories.  The index lives in an SQLite
+# database next to the repository files, shared between the agents;
+# each update is a single transaction.  When the database is created
+# it is filled once from the .dqminfo files already in the repository.
+# The agents never remove .dqminfo files, but files removed by hand or
+# registered by tools not using the index would leave it out of step,
+# so newest() checks the versions around the newest known one against
+# the repository and corrects the index on a mismatch.
+class VersionIndex:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS versions (
+          pattern TEXT, version INTEGER, PRIMARY KEY (pattern, version));
+        CREATE TABLE IF NOT EXISTS meta (
+          name TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, repo, path=None):
+        self.repo = repo
+        self.path = path or "%s/.versions.db" % repo
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+        if not self._built():
+            self.rebuild(missing=True)
+
+    def _built(self):
+        row = self.db.execute("SELECT 1 FROM meta WHERE name = 'built'").fetchone()
+        return row is not None
+
+    # Rebuild the index from the .dqminfo files in the repository.  If
+    # MISSING is set, leave alone an index another agent built meanwhile.
+    def rebuild(self, missing=False):
+        rows = []
+        for dir, subdirs, files in os.walk(self.repo):
+            for f in files:
+                if not f.endswith(".dqminfo"):
+                    continue
+                m = RXVERSION.search(f)
+                if m:
+                    path = "%s/%s" % (dir, f[: -len(".dqminfo")])
+                    path = os.path.relpath(path, self.repo)
+                    rows.append((version_pattern(path), int(m.group(1))))
+
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            if missing and self._built():
+                self.db.execute("COMMIT")
+                return
+            self.db.execute("DELETE FROM versions")
+            self.db.executemany("INSERT OR IGNORE INTO versions VALUES (?, ?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('built', '1')")
+            self.db.execute("COMMIT")
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+
+    # Return the sorted list of known versions of PATTERN.
+    def versions(self, pattern):
+        self.newest(pattern)
+        return [
+            v
+            for (v,) in self.db.execute(
+                "SELECT version FROM versions WHERE pattern = ? ORDER BY version",
+                (pattern,),
+            )
+        ]
+
+    # Return the newest version of PATTERN, or zero if none.  A newest
+    # version whose .dqminfo file no longer exists is forgotten, and any
+    # versions registered after it without the index are added.  This
+    # costs a stat() or two instead of globbing the run directory.
+    def newest(self, pattern):
+        v = self._newest(pattern)
+        while v and not self._exists(pattern, v):
+            self.remove(pattern, v)
+            v = self._newest(pattern)
+        while self._exists(pattern, v + 1):
+            v += 1
+            self.add(pattern, v)
+        return v
+
+    def _newest(self, pattern):
+        (v,) = self.db.execute(
+            "SELECT MAX(version) FROM versions WHERE pattern = ?", (pattern,)
+        ).fetchone()
+        return v or 0
+
+    def _exists(self, pattern, version):
+        return os.path.exists("%s/%s.dqminfo" % (self.repo, pattern % version))
+
+    # Return the version to assign to a new file of PATTERN.
+    def next(self, pattern):
+        return self.newest(pattern) + 1
+
+    # Return True if VERSION is the newest known version of PATTERN.
+    def isNewest(self, pattern, version):
+        return version >= self.newest(pattern)
+
+    # Record VERSION of PATTERN as present in the repository.
+    def add(self, pattern, version):
+        self.db.execute(
+            "INSERT OR IGNORE INTO versions VALUES (?, ?)", (pattern, version)
+        )
+
+    # Forget VERSION of PATTERN, when its files have been removed.
+    def remove(self, pattern, version):
+        self.db.execute(
+            "DELETE FROM versions WHERE pattern = ? AND version = ?",
+            (pattern, version),
+        )
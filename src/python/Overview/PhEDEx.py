@@ -7,6 +7,7 @@ from Monitoring.Core.Plot import (
     stitchPlotAndLegend,
 )
 from Monitoring.Core.Utils.Common import _logwarn, timeseries
+from Monitoring.Core.Cache import CacheStats
 from Monitoring.Overview.GUI import CompWorkspace
 from cherrypy import HTTPError
 from threading import Lock
@@ -90,6 +91,10 @@ class PhEDExSource:
     def __init__(self, server, statedir, dbcfg, *args):
         self.lock = Lock()
         self.imgcache = {}
+        self.imgstats = CacheStats("PhEDExImageCache")
+        for e in server.extensions:
+            if getattr(e, "exthook", None) == "OverviewCache":
+                e.registerStats(self.imgstats)
         self.dbparam = []
         self.db = {}
         execfile(dbcfg, globals(), {"dbparam": self.dbparam})
@@ -675,6 +680,9 @@ class PhEDExSource:
         # entry so that concurrent accesses will access the same data.
         self.lock.acquire()
         for old in [k for k, v in self.imgcache.items() if v["valid"] < now]:
+            oldwhat = old.split(":", 2)[1]
+            self.imgstats.held(oldwhat, -self.imgcache[old].get("bytes", 0))
+            self.imgstats.count(oldwhat, "evict-expired")
             del self.imgcache[old]
         if imgkey not in self.imgcache:
             cached = self.imgcache[imgkey] = {"lock": Lock(), "valid": 0}
@@ -683,8 +691,12 @@ class PhEDExSource:
         self.lock.release()
 
         try:
+            start = time.time()
             cached["lock"].acquire()
+            acquired = time.time()
+            self.imgstats.timing(what, "wait", acquired - start)
             imgtype, imgdata = cached.get(part, (None, None))
+            self.imgstats.count(what, (imgtype and "hit") or "miss")
             plot = json = None
 
             # Draw the plot
@@ -944,6 +956,15 @@ class PhEDExSource:
                     cached["plot"] = (types[type], json)
                     cached["legend"] = (types[type], repr(d.legend))
                 cached["info"] = ("text/plain", repr(plot.details()))
+
+                # Account for the newly produced data, less whatever data
+                # of an earlier render it replaced.
+                size = sum(len(cached[p][1] or "") for p in ("plot", "legend", "info"))
+                self.imgstats.held(what, size - cached.get("bytes", 0))
+                cached["bytes"] = size
+                self.imgstats.timing(what, "produce", time.time() - acquired)
+                self.imgstats.count(what, "insert")
+
                 if part == "plot+legend":
                     imgtype, imgdata = cached["plot"][0], stitchPlotAndLegend(
                         cached["plot"][1], cached["legend"][1]
@@ -1577,14 +1577,18 @@ class ProdMonQuery:
 class ProdMonQueryResult:
     """
     Parses the raw data from an xml request (using DOM) and provides an iterator over the items it returns.
+    Results are never modified after parsing, so the OverviewCache holds them by reference.
     """
 
+    cacheImmutable = True
+
     def __init__(self, data):
         """
         Create a new Query result from raw XML data
         """
         dom = parseString(data)
-        self.items = []
+        self.nbytes = len(data)
+        items = []
         for item in dom.getElementsByTagName("item"):
             result = {}
             for c in item.childNodes:
@@ -1594,8 +1598,15 @@ class ProdMonQueryResult:
                     result[tagname] = child
                 else:
                     result[tagname] = ""
-            self.items.append(result)
+            items.append(result)
         dom.unlink()
+        self.items = tuple(items)
+
+    def cacheSize(self):
+        """
+        Approximate memory held by this result, for OverviewCache size accounting.
+        """
+        return self.nbytes
 
     def __getitem__(self, i):
         """
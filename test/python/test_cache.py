@@ -0,0 +1,284 @@
+# To run the test: py.test -s -v test_cache.py
+
+import threading, time
+import pytest
+from Monitoring.Core.Cache import OverviewCache
+
+
+@pytest.fixture
+def cache():
+    c = OverviewCache(None, interval=1, wait_expiry=5)
+    yield c
+    c.stop()
+
+
+def _concurrent(n, target):
+    results, errors = [None] * n, [None] * n
+
+    def run(i):
+        try:
+            results[i] = target()
+        except BaseException as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+def test_locked_fetch_produces_once(cache):
+    calls = []
+
+    def produce():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"n": 1}, 60
+
+    results, errors = _concurrent(5, lambda: cache.lockedCacheFetch("k", produce))
+    assert len(calls) == 1
+    assert errors == [None] * 5
+    assert all(r == {"n": 1} for r in results)
+
+
+def test_locked_fetch_waiters_get_private_copies(cache):
+    def produce():
+        time.sleep(0.2)
+        return {"n": 1}, 60
+
+    results, errors = _concurrent(5, lambda: cache.lockedCacheFetch("k", produce))
+    assert len(set(id(r) for r in results)) == 5
+    results[0]["n"] = 2
+    assert all(r == {"n": 1} for r in results[1:])
+    assert cache.retrieve("k") == {"n": 1}
+
+
+def test_locked_fetch_waiters_get_private_copies_uncached(cache):
+    def produce():
+        time.sleep(0.2)
+        return [1], 0
+
+    results, errors = _concurrent(4, lambda: cache.lockedCacheFetch("k", produce))
+    assert results == [[1]] * 4
+    assert len(set(id(r) for r in results)) == 4
+
+
+def test_locked_fetch_shares_immutable_data(cache):
+    data = b"x" * 100
+
+    def produce():
+        time.sleep(0.2)
+        return data, 60
+
+    results, errors = _concurrent(3, lambda: cache.lockedCacheFetch("k", produce))
+    assert all(r is data for r in results)
+
+
+def test_locked_fetch_propagates_errors(cache):
+    def produce():
+        time.sleep(0.2)
+        raise ValueError("boom")
+
+    results, errors = _concurrent(3, lambda: cache.lockedCacheFetch("k", produce))
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert "k" not in cache
+
+
+def test_locked_fetch_producer_abort_reaches_waiters(cache):
+    class Abort(BaseException):
+        pass
+
+    started = threading.Event()
+
+    def produce():
+        started.set()
+        time.sleep(0.2)
+        raise Abort()
+
+    def waiter():
+        started.wait()
+        return cache.lockedCacheFetch("k", lambda: ({"late": 1}, 60))
+
+    producer = threading.Thread(
+        target=lambda: pytest.raises(Abort, cache.lockedCacheFetch, "k", produce)
+    )
+    producer.start()
+    results, errors = _concurrent(2, waiter)
+    producer.join()
+    assert all(isinstance(e, RuntimeError) for e in errors)
+    assert not cache.key_wait_get("k")
+
+
+def test_stale_entries_not_served_by_default(cache):
+    cache.insert("k", 0.1, "old")
+    time.sleep(0.2)
+    assert cache.retrieve("k") is None
+    assert cache.cacheFetch("k", lambda: ("new", 60)) == "new"
+
+
+def test_positional_arguments_keep_their_slots():
+    cache = OverviewCache(None, 1, 1000, 10, 60, 5, 30)
+    try:
+        assert (cache.wait_expiry, cache.stale_grace) == (60, 30)
+    finally:
+        cache.stop()
+
+
+def test_stale_entry_served_while_refreshing():
+    cache = OverviewCache(None, interval=1, stale_grace=60)
+    try:
+        cache.insert("k", 0.1, "old")
+        time.sleep(0.2)
+        refreshed = threading.Event()
+
+        def produce():
+            refreshed.set()
+            return "new", 60
+
+        assert cache.lockedCacheFetch("k", produce) == "old"
+        assert refreshed.wait(5)
+        for _ in range(50):
+            if cache.retrieve("k") == "new":
+                break
+            time.sleep(0.05)
+        assert cache.retrieve("k") == "new"
+    finally:
+        cache.stop()
+
+
+def test_background_fill_joins_single_flight(cache):
+    calls = []
+    release = threading.Event()
+
+    def produce():
+        calls.append(1)
+        release.wait(5)
+        return {"n": 1}, 60
+
+    cache.asyncCacheFill("k", produce)
+    for _ in range(50):
+        if cache.key_wait_get("k"):
+            break
+        time.sleep(0.01)
+    assert cache.key_wait_get("k")
+    threading.Timer(0.2, release.set).start()
+    assert cache.lockedCacheFetch("k", produce) == {"n": 1}
+    assert len(calls) == 1
+
+
+def test_stop_does_not_block_on_full_refresh_queue():
+    cache = OverviewCache(None, interval=1, refresh_threads=1, refresh_queue=1)
+    release = threading.Event()
+    for i in range(5):
+        cache.asyncCacheFill("k%d" % i, lambda: (release.wait(5), 60))
+    start = time.time()
+    cache.stop()
+    assert time.time() - start < 1
+    release.set()
+
+
+def test_stats_page_exposes_only_stats(cache):
+    import json
+    from Monitoring.Core.Cache import _CacheStatsPage
+
+    page = _CacheStatsPage(cache)
+    cache.cacheFetch("PA_PLOT|x", lambda: ("data", 60))
+    cache.cacheFetch("PA_PLOT|x", lambda: ("data", 60))
+    stats = json.loads(page.stats())
+    counts = stats["caches"][0]["prefixes"]["PA_PLOT"]["counts"]
+    assert counts["miss"] == 1 and counts["hit"] == 1
+    assert [n for n in dir(page) if getattr(getattr(page, n), "exposed", False)] == [
+        "stats"
+    ]
+
+
+def test_store_enforces_item_limit(tmp_path):
+    from Monitoring.Core.Cache import SQLiteCacheStore
+
+    store = SQLiteCacheStore(str(tmp_path / "cache.db"), 10**6, itemlimit=3)
+    for i in range(5):
+        store.put("k%d" % i, time.time() + 60, time.time() + 60, True, b"x")
+        time.sleep(0.01)
+    assert store.get("k0") is None and store.get("k1") is None
+    assert all(store.get("k%d" % i) for i in range(2, 5))
+    (n,) = store.db.execute("SELECT n FROM items").fetchone()
+    assert n == 3
+
+
+def test_store_reads_update_stale_atime_only(tmp_path):
+    from Monitoring.Core.Cache import SQLiteCacheStore
+
+    store = SQLiteCacheStore(str(tmp_path / "cache.db"), 10**6)
+    store.put("k", time.time() + 600, time.time() + 600, True, b"x")
+    changes = store.db.total_changes
+    assert store.get("k")[3] == b"x"
+    assert store.db.total_changes == changes
+
+    store.db.execute("UPDATE entries SET atime = ?", (time.time() - 120,))
+    changes = store.db.total_changes
+    store.get("k")
+    assert store.db.total_changes == changes + 1
+    (atime,) = store.db.execute("SELECT atime FROM entries").fetchone()
+    assert time.time() - atime < 60
+
+
+def test_shared_store_between_caches(tmp_path):
+    path = str(tmp_path / "cache.db")
+    first = OverviewCache(None, interval=1, store=path)
+    second = OverviewCache(None, interval=1, store=path)
+    try:
+        first.insert("k", 60, {"n": 1})
+        for _ in range(50):
+            if first.store.get("k"):
+                break
+            time.sleep(0.02)
+        assert "k" not in second
+        assert second.retrieve("k") == {"n": 1}
+        assert "k" in second
+    finally:
+        first.stop()
+        second.stop()
+
+
+def test_item_limit_evicts_least_recently_used():
+    cache = OverviewCache(None, interval=1, itemlimit=3)
+    try:
+        for k in "abc":
+            cache.insert(k, 60, k)
+        cache.retrieve("a")
+        cache.insert("d", 60, "d")
+        assert sorted(cache.keylist()) == ["a", "c", "d"]
+    finally:
+        cache.stop()
+
+
+def test_size_limit_evicts_least_recently_used():
+    cache = OverviewCache(None, interval=1, sizelimit=250)
+    try:
+        for k in "abc":
+            cache.insert(k, 60, k * 100)
+        assert sorted(cache.keylist()) == ["b", "c"]
+        assert cache.cachesize == 200
+    finally:
+        cache.stop()
+
+
+def test_expired_entries_are_culled(cache):
+    cache.insert("short", 0.1, "x")
+    cache.insert("long", 60, "y")
+    time.sleep(0.2)
+    cache.lock.acquire()
+    try:
+        cache._cull_expired()
+    finally:
+        cache.lock.release()
+    assert cache.keylist() == ["long"]
+
+
+def test_reinserting_keys_keeps_expiry_heap_bounded(cache):
+    for i in range(1000):
+        cache.insert("k", 60, i)
+    assert len(cache.expiries) <= 2 * len(cache.cache) + 64
+    assert cache.retrieve("k") == 999
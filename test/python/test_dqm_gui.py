@@ -0,0 +1,368 @@
+# To run the test: py.test -s -v test_dqm_gui.py
+
+import collections, hashlib, io, json, os, struct, threading, time, zlib
+import pytest
+from cherrypy import HTTPError
+
+try:
+    from Monitoring.DQM import GUI
+except ImportError:
+    pytest.skip("needs the DQM GUI C++ extension", allow_module_level=True)
+
+
+def _write_generation(indexdir, counter, mtime):
+    path = os.path.join(indexdir, "generation")
+    with open(path, "wb") as f:
+        f.write(struct.pack("=I", counter))
+    os.utime(path, ns=(mtime, mtime))
+
+
+def _archive(indexdir):
+    source = GUI.DQMArchiveSource.__new__(GUI.DQMArchiveSource)
+    source.opts = {"index": indexdir}
+    source._generation = (0, None)
+    return source
+
+
+def test_archive_validator_changes_within_a_second(tmp_path):
+    indexdir = str(tmp_path)
+    second = int(time.time() - 3600) * 10**9
+    _write_generation(indexdir, 7, second + 1000)
+    source = _archive(indexdir)
+    first = source.validator("1", "A", "B", "C", "x")
+
+    _write_generation(indexdir, 8, second + 2000)
+    source._generation = (0, None)
+    assert source.validator("1", "A", "B", "C", "x")[0] != first[0]
+    assert source.validator("1", "A", "B", "C", "x")[1] == first[1]
+
+
+def test_archive_images_shared_across_sessions(tmp_path):
+    indexdir = str(tmp_path)
+    _write_generation(indexdir, 1, int(time.time() - 3600) * 10**9)
+    source = _archive(indexdir)
+    source.images = GUI.DQMImageCache(1000)
+    calls = []
+    source._plot = lambda *args: calls.append(args) or ("image/png", b"png")
+
+    plot = lambda **opts: source.plot("1", "A", "B", "C", "x", **opts)
+    assert plot(session="s1", w="266", v="1") == plot(session="s2", w="266", stamp="5")
+    assert len(calls) == 1
+    assert source.validator("1", "A", "B", "C", "x", session="s1") == (
+        source.validator("1", "A", "B", "C", "x", session="s2")
+    )
+    plot(session="s1", w="400")
+    assert len(calls) == 2
+
+
+def test_live_images_shared_across_sessions():
+    source = GUI.DQMLiveSource.__new__(GUI.DQMLiveSource)
+    source.images = GUI.DQMImageCache(1000)
+    source._version = lambda name: 3
+    calls = []
+
+    def slow(name, options):
+        calls.append(name)
+        time.sleep(0.2)
+        return ("image/png", b"png")
+
+    source._plot = slow
+    sessions = ["s1", "s2", "s3", "s4"]
+    plot = lambda: source.plot("1", "A", "B", "C", "x", session=sessions.pop())
+    results, errors = _render_in_threads(4, plot)
+    assert calls == ["x"] and errors == [None] * 4
+    assert results == [("image/png", b"png")] * 4
+
+
+def test_archive_validator_waits_for_settled_generation(tmp_path):
+    indexdir = str(tmp_path)
+    _write_generation(indexdir, 1, time.time_ns())
+    assert _archive(indexdir).validator("1", "A", "B", "C", "x") is None
+
+
+def _render_in_threads(n, target):
+    results, errors = [None] * n, [None] * n
+
+    def run(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+def test_image_cache_renders_once():
+    images = GUI.DQMImageCache(1000)
+    calls = []
+
+    def render():
+        calls.append(1)
+        time.sleep(0.2)
+        return ("image/png", b"png")
+
+    results, errors = _render_in_threads(4, lambda: images.get(1, "k", render))
+    assert len(calls) == 1
+    assert results == [("image/png", b"png")] * 4
+    assert images.size == 3
+
+
+def test_image_cache_skips_failed_renders():
+    images = GUI.DQMImageCache(1000)
+    assert images.get(1, "k", lambda: (None, None)) == (None, None)
+    assert images.get(1, "k", lambda: ("image/png", b"png")) == ("image/png", b"png")
+    assert images.size == 3
+
+
+def test_image_cache_waiters_render_after_timeout():
+    images = GUI.DQMImageCache(1000, waittime=0.1)
+    release = threading.Event()
+
+    def slow():
+        release.wait(5)
+        return ("image/png", b"slow")
+
+    owner = threading.Thread(target=images.get, args=(1, "k", slow))
+    owner.start()
+    while "k" not in images.inflight:
+        time.sleep(0.01)
+    start = time.time()
+    assert images.get(1, "k", lambda: ("image/png", b"own")) == ("image/png", b"own")
+    assert time.time() - start < 2
+    release.set()
+    owner.join()
+
+
+def test_image_cache_waiters_render_if_owner_aborts():
+    images = GUI.DQMImageCache(1000)
+    started = threading.Event()
+
+    class Abort(BaseException):
+        pass
+
+    def aborted():
+        started.set()
+        time.sleep(0.2)
+        raise Abort()
+
+    def owner():
+        with pytest.raises(Abort):
+            images.get(1, "k", aborted)
+
+    t = threading.Thread(target=owner)
+    t.start()
+    started.wait()
+    assert images.get(1, "k", lambda: ("image/png", b"own")) == ("image/png", b"own")
+    t.join()
+    assert "k" not in images.images
+
+
+# A listing in the form returned by the C++ layer, with a doubly quoted
+# scalar value and a bare nan, for a tree of /A/x, /A/B/y and /A/B/hist.
+LISTINGS = {
+    "": '{"contents": [{"subdir": "A"}]}',
+    "A": '{"contents": [{"subdir": "B"},'
+    ' {"obj": "x", "path": "A/x", "value": ""on""}]}',
+    "A/B": '{"contents": [{"obj": "y", "path": "A/B/y", "value": "1"},'
+    ' {"obj": "hist", "path": "A/B/hist", "mean": nan, "rms": nan}]}',
+}
+
+
+class _Source:
+    def getJson(self, runnr, dsP, dsW, dsT, *path, **options):
+        if path[-1] == "hist":
+            raise ValueError("no data")
+        return '{"name": "%s"}' % "/".join(path)
+
+
+def _tojson(listings=LISTINGS):
+    source = _Source()
+    server = type("Server", (), {})()
+    server.sources = [source]
+    server.plothooks = {"archive": source}
+    server.jsonhooks = {"archive": source}
+    tojson = GUI.DQMToJSON.__new__(GUI.DQMToJSON)
+    tojson.server = server
+    tojson._list = lambda layout, src, runnr, ds, path, opts: (0, listings[path])
+    return tojson
+
+
+def test_load_listing_fixes_up_raw_listings():
+    from Monitoring.DQM.visDQMUtils import load_listing
+
+    assert load_listing(LISTINGS["A"])["contents"][1]["value"] == "on"
+    hist = load_listing(LISTINGS["A/B"])["contents"][1]
+    assert hist["mean"] == "NaN" and hist["rms"] == "NaN"
+
+
+def test_batch_globs_raw_listing():
+    out = "".join(_tojson().batch("archive", "1", "A", "B", "C", dir="A/B", glob="*"))
+    results = json.loads(out)["results"]
+    assert [r["path"] for r in results] == ["A/B/y", "A/B/hist"]
+    assert results[0]["json"] == {"name": "A/B/y"}
+    assert results[1]["error"] == "no data"
+
+
+def test_search_walks_raw_listings():
+    out = "".join(_tojson().search("archive", "1", "A", "B", "C", glob="/**/*"))
+    results = json.loads(out)["results"]
+    assert [r["path"] for r in results] == ["/A/x", "/A/B/y", "/A/B/hist"]
+    assert results[2]["item"]["mean"] == "NaN"
+
+
+def test_search_rejects_bad_glob():
+    for glob in ("A/*", "", "/"):
+        with pytest.raises(HTTPError) as e:
+            _tojson().search("archive", "1", "A", "B", "C", glob=glob)
+        assert e.value.status == 400
+
+
+def test_search_matches_directories_with_trailing_slash():
+    out = "".join(_tojson().search("archive", "1", "A", "B", "C", glob="/*/B/"))
+    assert [r["path"] for r in json.loads(out)["results"]] == ["/A/B"]
+
+
+def test_search_failure_keeps_json_valid():
+    listings = dict(LISTINGS)
+    del listings["A/B"]
+    out = "".join(
+        _tojson(listings).search("archive", "1", "A", "B", "C", glob="/**/*")
+    )
+    reply = json.loads(out)
+    assert [r["path"] for r in reply["results"]] == ["/A/x"]
+    assert "A/B" in reply["error"]
+
+
+class _Request:
+    def __init__(self, body=b"", **headers):
+        self.rfile = io.BytesIO(body)
+        self.headers = headers
+
+
+class _Response:
+    def __init__(self):
+        self.headers = {}
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    access = GUI.DQMFileAccess.__new__(GUI.DQMFileAccess)
+    access.locks = [threading.Lock() for _ in range(4)]
+    access.uploads = str(tmp_path)
+    access.chunked = str(tmp_path / "chunked")
+    access.digests = {}
+    os.makedirs(access.chunked)
+    monkeypatch.setattr(GUI, "request", _Request())
+    monkeypatch.setattr(GUI, "response", _Response())
+
+    def call(action, id=None, body=None, headers=None, **kwargs):
+        if body is not None and headers is None:
+            headers = {"Content-Length": str(len(body))}
+        monkeypatch.setattr(GUI, "request", _Request(body or b"", **(headers or {})))
+        monkeypatch.setattr(GUI, "response", _Response())
+        return access.upload(action, id, **kwargs)
+
+    return access, call
+
+
+FILENAME = "DQM_V0001_R000000001__A__B__DQM.root"
+DATA = b"root\x00" + bytes(range(256)) * 40
+
+
+def _chunks(size):
+    return [(o, DATA[o : o + size]) for o in range(0, len(DATA), size)]
+
+
+def _stored(access):
+    with open(os.path.join(access.uploads, "0001", FILENAME), "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("order", [1, -1])
+def test_chunked_upload_in_any_order(uploads, order):
+    access, call = uploads
+    id = call("open", filename=FILENAME, size=str(len(DATA)))
+    for offset, data in _chunks(3000)[::order]:
+        call("chunk", id, data, offset=str(offset))
+    summed = access.digests[access.chunked + "/" + id][0]
+    assert summed == (order == 1 and len(DATA) or 3000)
+    checksum = "md5:" + hashlib.md5(DATA).hexdigest()
+    assert call("finish", id, checksum=checksum) == "Thanks.\n"
+    assert _stored(access) == DATA
+    assert access.digests == {}
+
+
+def test_chunked_upload_rewrite_discards_running_checksum(uploads):
+    access, call = uploads
+    id = call("open", filename=FILENAME, size=str(len(DATA)))
+    for offset, data in _chunks(3000):
+        call("chunk", id, b"x" * len(data), offset=str(offset))
+    for offset, data in _chunks(4000)[::-1]:
+        call("chunk", id, data, offset=str(offset))
+    checksum = "crc32:%d" % zlib.crc32(DATA)
+    call("finish", id, checksum=checksum)
+    assert _stored(access) == DATA
+
+
+def test_chunk_requires_content_length(uploads):
+    access, call = uploads
+    id = call("open", filename=FILENAME, size=str(len(DATA)))
+    for headers in ({}, {"Transfer-Encoding": "chunked"}):
+        with pytest.raises(HTTPError) as e:
+            call("chunk", id, DATA, headers=headers, offset="0")
+        assert e.value.status == 411
+    assert call("status", id) == json.dumps(
+        {"filename": FILENAME, "size": len(DATA), "received": []}
+    )
+
+
+def test_chunk_after_finish_is_not_found(uploads):
+    access, call = uploads
+    id = call("open", filename=FILENAME, size=str(len(DATA)))
+    call("chunk", id, DATA, offset="0")
+    call("finish", id, checksum="md5:" + hashlib.md5(DATA).hexdigest())
+    with pytest.raises(HTTPError) as e:
+        call("chunk", id, DATA[:10], offset="0")
+    assert e.value.status == 404
+    status = GUI.response.headers["dqm-status-code"]
+    assert status == str(access.STATUS_ERROR_NOT_EXISTS)
+
+
+def _listing(tmp_path):
+    access = GUI.DQMFileAccess.__new__(GUI.DQMFileAccess)
+    access.listlock = threading.Lock()
+    access.listings = collections.OrderedDict()
+    dir = tmp_path / "files"
+    dir.mkdir()
+    for name in ("a.root", "b.root"):
+        (dir / name).write_bytes(b"x")
+    old = time.time() - 60
+    os.utime(str(dir), (old, old))
+    return access, str(dir)
+
+
+def test_listing_cached_while_directory_unchanged(tmp_path, monkeypatch):
+    access, dir = _listing(tmp_path)
+    files = access._listing(dir, os.stat(dir))
+    assert [f[0] for f in files] == ["b.root", "a.root"]
+
+    calls = []
+    listdir, stat = os.listdir, os.stat
+    monkeypatch.setattr(os, "listdir", lambda p: calls.append(p) or listdir(p))
+    monkeypatch.setattr(os, "stat", lambda p, **kw: calls.append(p) or stat(p, **kw))
+    dirst = stat(dir)
+    assert access._listing(dir, dirst) is files
+    assert calls == []
+
+
+def test_listing_reread_when_directory_changes(tmp_path):
+    access, dir = _listing(tmp_path)
+    files = access._listing(dir, os.stat(dir))
+    os.rename(os.path.join(dir, "a.root"), os.path.join(dir, "c.root"))
+    files = access._listing(dir, os.stat(dir))
+    assert [f[0] for f in files] == ["c.root", "b.root"]
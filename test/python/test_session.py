@@ -0,0 +1,163 @@
+# To run the test: py.test -s -v test_session.py
+
+import os, pickle, time
+from Monitoring.Core.GUI import Session, SessionRegistry, SessionReaper, SessionThread
+
+
+def _flush(thread):
+    # Run one pass of the session thread loop in the calling thread.
+    thread.stop()
+    thread.run()
+    thread._stopme = False
+
+
+def _save(thread, session):
+    thread.save(session["core.name"], *session.snapshot())
+    _flush(thread)
+
+
+def _records(path):
+    records = []
+    if os.path.exists(path + ".journal"):
+        with open(path + ".journal", "rb") as _f:
+            while True:
+                try:
+                    records.append(pickle.load(_f))
+                except EOFError:
+                    return records
+    return records
+
+
+def _session(**kwargs):
+    s = Session({"core.name": "s1", "core.clientid": "x"})
+    s.update(kwargs)
+    return s
+
+
+def test_journal_replays_to_saved_state(tmp_path):
+    thread = SessionThread(str(tmp_path))
+    s = _session(a=1, b={"x": 1})
+    _save(thread, s)
+    s["a"] = 2
+    s["b"]["y"] = 2
+    del s["core.clientid"]
+    _save(thread, s)
+    assert len(_records(str(tmp_path / "s1"))) == 1
+    assert SessionThread(str(tmp_path)).load("s1") == {
+        "core.name": "s1",
+        "a": 2,
+        "b": {"x": 1, "y": 2},
+    }
+
+
+def test_journal_records_only_dirty_keys(tmp_path):
+    thread = SessionThread(str(tmp_path))
+    s = _session(a=1, big=list(range(1000)))
+    _save(thread, s)
+    s["a"] = 2
+    _save(thread, s)
+    (record,) = _records(str(tmp_path / "s1"))
+    assert record[1] == {"a": 2} and record[2] == []
+
+
+def test_stale_journal_ignored_after_compaction(tmp_path, monkeypatch):
+    thread = SessionThread(str(tmp_path))
+    thread.maxrecords = 1
+    s = _session(c=10)
+    _save(thread, s)
+    s["c"] = 20
+    _save(thread, s)
+
+    # Crash between publishing the new snapshot and removing the journal.
+    monkeypatch.setattr(os, "remove", lambda path: None)
+    s["c"] = 30
+    _save(thread, s)
+    monkeypatch.undo()
+
+    assert os.path.exists(str(tmp_path / "s1.journal"))
+    assert SessionThread(str(tmp_path)).load("s1")["c"] == 30
+
+
+def test_legacy_session_files_still_load(tmp_path):
+    path = str(tmp_path / "s1")
+    with open(path, "wb") as _f:
+        pickle.dump({"a": 1, "b": 2}, _f)
+    with open(path + ".journal", "wb") as _f:
+        _f.write(pickle.dumps(({"a": 3}, ["b"])))
+    assert SessionThread(str(tmp_path)).load("s1") == {"a": 3}
+
+
+def test_pending_changes_returned_by_load(tmp_path):
+    thread = SessionThread(str(tmp_path))
+    s = _session(a=1, b=2)
+    _save(thread, s)
+    s["a"] = 5
+    del s["b"]
+    thread.save("s1", *s.snapshot())
+    s["c"] = 7
+    thread.save("s1", *s.snapshot())
+    assert thread.load("s1") == {
+        "core.name": "s1",
+        "core.clientid": "x",
+        "a": 5,
+        "c": 7,
+    }
+    _flush(thread)
+    assert SessionThread(str(tmp_path)).load("s1") == thread.load("s1")
+
+
+def test_snapshot_holds_only_dirty_values():
+    s = _session(a=[1], b=2)
+    s.snapshot()
+    s["a"].append(2)
+    assert s.snapshot() == ({"a": [1, 2]}, {"a"})
+    assert s.snapshot() == ({}, set())
+    assert not hasattr(s, "lastsnap")
+
+
+def test_compaction_after_restart_keeps_journal_state(tmp_path):
+    thread = SessionThread(str(tmp_path))
+    s = _session(a=1, b=1)
+    _save(thread, s)
+    s["a"] = 2
+    _save(thread, s)
+
+    restarted = SessionThread(str(tmp_path))
+    s = Session(restarted.load("s1"))
+    s.dirty = set()
+    s["b"] = 3
+    _save(restarted, s)
+    assert _records(str(tmp_path / "s1")) == []
+    assert SessionThread(str(tmp_path)).load("s1")["a"] == 2
+    assert SessionThread(str(tmp_path)).load("s1")["b"] == 3
+
+
+def test_reaper_limit_evicts_sessions_and_their_save_state(tmp_path):
+    thread = SessionThread(str(tmp_path))
+    registry = SessionRegistry(nshards=1)
+    for i in range(5):
+        s = Session({"core.name": "s%d" % i, "core.stamp": time.time()})
+        registry.add("s%d" % i, s)
+        _save(thread, s)
+    assert len(thread._persisted) == 5
+
+    reaper = SessionReaper(registry, limit=2, interval=0.05, sessionthread=thread)
+    reaper.start()
+    for _ in range(50):
+        if len(thread._persisted) == 2:
+            break
+        time.sleep(0.02)
+    reaper.stop()
+    reaper.join()
+    assert len(registry) == 2
+    assert sorted(thread._persisted) == ["s3", "s4"]
+    assert thread.load("s0")["core.name"] == "s0"
+
+def test_reap_skips_sessions_in_use():
+    registry = SessionRegistry(nshards=1)
+    s = Session({"core.name": "s0", "core.stamp": 0})
+    registry.add("s0", s)
+    s["core.lock"].acquire()
+    assert registry.reap(time.time()) == []
+    s["core.lock"].release()
+    assert registry.reap(time.time()) == ["s0"]
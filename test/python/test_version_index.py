@@ -0,0 +1,56 @@
+# To run the test: py.test -s -v test_version_index.py
+
+import os
+from Monitoring.DQM.visDQMUtils import VersionIndex, version_pattern
+
+PATTERN = "OnlineData/00012xxxx/0001234xx/DQM_V%04d_R000123456.root"
+
+
+def _register(repo, version):
+    path = os.path.join(str(repo), PATTERN % version)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".dqminfo", "w") as _f:
+        _f.write("{}\n")
+    return path
+
+
+def test_index_built_from_repository(tmp_path):
+    for v in (1, 2, 3):
+        _register(tmp_path, v)
+    index = VersionIndex(str(tmp_path))
+    assert index.versions(PATTERN) == [1, 2, 3]
+    assert index.next(PATTERN) == 4
+    assert index.isNewest(PATTERN, 3) and not index.isNewest(PATTERN, 2)
+    assert version_pattern(PATTERN % 3) == PATTERN
+
+
+def test_add_and_remove(tmp_path):
+    index = VersionIndex(str(tmp_path))
+    _register(tmp_path, 1)
+    index.add(PATTERN, 1)
+    _register(tmp_path, 2)
+    index.add(PATTERN, 2)
+    assert index.versions(PATTERN) == [1, 2]
+    index.remove(PATTERN, 1)
+    assert index.versions(PATTERN) == [2]
+    assert VersionIndex(str(tmp_path)).versions(PATTERN) == [2]
+
+
+def test_removed_newest_version_is_forgotten(tmp_path):
+    for v in (1, 2, 3):
+        _register(tmp_path, v)
+    index = VersionIndex(str(tmp_path))
+    os.remove(_register(tmp_path, 3) + ".dqminfo")
+    assert index.newest(PATTERN) == 2
+    assert index.isNewest(PATTERN, 2)
+    assert index.versions(PATTERN) == [1, 2]
+
+
+def test_unindexed_new_version_is_picked_up(tmp_path):
+    _register(tmp_path, 1)
+    index = VersionIndex(str(tmp_path))
+    _register(tmp_path, 2)
+    _register(tmp_path, 3)
+    assert not index.isNewest(PATTERN, 2)
+    assert index.next(PATTERN) == 4
+    assert index.versions(PATTERN) == [1, 2, 3]